@@ -6,6 +6,7 @@ import { ref, uploadBytes, getDownloadURL } from "firebase/storage";
 import { LoadingOverlay } from './components/Loading';
 import "./App.css";
 import Palette from "./components/Palette";
+import { countShapes } from "./paletteFormat";
 
 const dir = ".";
 let imageFiles = ["panda", "landscape", "flower", "portrait"];
@@ -23,7 +24,7 @@ function App() {
 
   useEffect(() => {
     const counts = idList.reduce((acc, value) => {
-      acc[value.color] = value.shapes.length;
+      acc[value.color] = countShapes(value.shapes);
       return acc;
     }, {});
     
@@ -6,6 +6,7 @@ import { ref, getDownloadURL } from "firebase/storage";
 import storage from '../../firebaseConfig';
 import { LoadingOverlay } from './Loading';
 import axios from 'axios';
+import { countShapes, decodePalette, extractPalette, hasShape, shapeIds } from '../paletteFormat';
 
 const minLoadingTime = 800
 
@@ -25,7 +26,9 @@ export const Canvas = ({
 
   const handleItemClick = (id, color) => {
     const element = document.getElementById(id);
-    if (element && element.getAttribute('fill') === 'lightpink') {
+    // Shapes of compact svgs take their fill from the group of their color until they are painted
+    const fill = element && (element.getAttribute('fill') || element.parentNode.getAttribute('fill'));
+    if (fill === 'lightpink') {
       element.setAttribute("fill", color);
       setColorCount((prevCount) => ({
         ...prevCount,
@@ -34,9 +37,18 @@ export const Canvas = ({
     }
   };
 
+  // One listener for the whole svg, the color of the clicked shape is found from the ranges of ids
+  const handleSvgClick = (event) => {
+    const element = event.target.closest('[id]');
+    const item = element && idList.find(({ shapes }) => hasShape(shapes, Number(element.id)));
+    if (item) {
+      handleItemClick(element.id, `rgb${item.color}`);
+    }
+  };
+
   const fillColors = () => {
     for (const { color, shapes } of idList) {
-      for (const id of shapes) {
+      for (const id of shapeIds(shapes)) {
         const element = document.getElementById(id);
         if (element) {
           element.setAttribute("fill", `rgb${color}`);
@@ -52,12 +64,20 @@ export const Canvas = ({
 
   const clearColors = () => {
     for (const item of idList) {
-      for (const id of item.shapes) {
+      const group = item.group && document.getElementById(item.group);
+      if (group) {
+        group.setAttribute("fill", "white");
+      }
+      for (const id of shapeIds(item.shapes)) {
         const element = document.getElementById(id);
         if (element) {
-          element.setAttribute("fill", "white");
+          if (group) {
+            element.removeAttribute("fill");
+          } else {
+            element.setAttribute("fill", "white");
+          }
           const counts = idList.reduce((acc, value) => {
-            acc[value.color] = value.shapes.length;
+            acc[value.color] = countShapes(value.shapes);
             return acc;
           }, {});
           setColorCount(counts)
@@ -67,15 +87,21 @@ export const Canvas = ({
   };
 
   const updatePathStrokes = (currentColor) => {
-    idList.forEach(({ color, shapes }) => {
-      shapes.forEach((id) => {
+    idList.forEach(({ color, shapes, group }) => {
+      // Compact svgs switch a whole color at once, painted shapes keep their own fill
+      const groupElement = group && document.getElementById(group);
+      if (groupElement) {
+        groupElement.setAttribute('fill', color === currentColor ? 'lightpink' : 'white');
+        return;
+      }
+      for (const id of shapeIds(shapes)) {
         const element = document.getElementById(id);
         const elementFill = element.getAttribute('fill')
         const isElementFilled = elementFill !== 'white' && elementFill !== 'lightpink'
         if (element && !isElementFilled) {  
           element.setAttribute('fill', color === currentColor ? 'lightpink' : 'white');          
         }
-      });
+      }
     });
   };
   
@@ -86,34 +112,6 @@ export const Canvas = ({
   }, [currentColor]);
 
 
-  useEffect(() => {
-    // Loop through the list of IDs and add event listeners
-    for (const { color, shapes } of idList) {
-      for (const id of shapes) {
-        const element = document.getElementById(id);
-        if (element) {
-          element.addEventListener("click", () =>
-            handleItemClick(id, `rgb${color}`)
-          );
-        }
-      }
-    }
-
-     // Cleanup: Remove event listeners when the component unmounts
-     return () => {
-      for (const { color, shapes } of idList) {
-        for (const id of shapes) {
-          const element = document.getElementById(id);
-          if (element) {
-            element.removeEventListener("click", () =>
-              handleItemClick(id, `rgb${color}`)
-            );
-          }
-        }
-      }
-    };
-  }, [idList])
-    
     useEffect(() => {
         const importSvg = async () => {
             setLoading(true);
@@ -128,7 +126,7 @@ export const Canvas = ({
                             import(`../assets/${baseFile}.json`), 
                             new Promise((resolve) => setTimeout(resolve, minLoadingTime))
                         ])
-                    setIdList(jsonFile.default);
+                    setIdList(decodePalette(jsonFile.default));
                     setSvgString(component.default)
                 } else {
                     // load from bucket
@@ -139,27 +137,29 @@ export const Canvas = ({
                     
                     // call cloud function to convert image to pbn if not already computed
                     let svgUrl;
-                    let jsonUrl;
                     try {
                         // retrieve results from bucket if already computed
-                        const results = await Promise.all([getDownloadURL(svgRef), getDownloadURL(jsonRef)]);
-                        svgUrl = results[0]
-                        jsonUrl = results[1];
+                        svgUrl = await getDownloadURL(svgRef);
                     } catch (err) {
                         const functions = getFunctions();
                         const callableReturnMessage = httpsCallable(functions, 'make_pbn');
                         // eslint-disable-next-line no-unused-vars
                         const funcRes = await callableReturnMessage({"id": imageFile});
 
-                        const results = await Promise.all([getDownloadURL(svgRef), getDownloadURL(jsonRef)]);
-                        svgUrl = results[0]
-                        jsonUrl = results[1];
+                        svgUrl = await getDownloadURL(svgRef);
                     }
                     // retrieve results from bucket
-                    const [svgRes, jsonRes] = await Promise.all([axios.get(svgUrl), axios.get(jsonUrl)])
+                    const svgRes = await axios.get(svgUrl)
+
+                    // bundled svgs carry their palette, older results keep it in a separate json
+                    let palette = extractPalette(svgRes.data);
+                    if (!palette) {
+                        const jsonRes = await axios.get(await getDownloadURL(jsonRef));
+                        palette = decodePalette(jsonRes.data);
+                    }
 
                     // update component data
-                    setIdList(jsonRes.data);
+                    setIdList(palette);
                     setSvgString(svgRes.data);
                 }
             } catch (error) {
@@ -198,7 +198,7 @@ export const Canvas = ({
             {!loading && <div className='svg-container'>
                 <TransformComponent>
                     {errorMsg ? (<div> {errorMsg} </div>) 
-                    : (<div dangerouslySetInnerHTML={{ __html: svgString }} className='svg-element'></div>)}
+                    : (<div dangerouslySetInnerHTML={{ __html: svgString }} className='svg-element' onClick={handleSvgClick}></div>)}
                 </TransformComponent>
               </div>
             }
@@ -1,5 +1,6 @@
 import React from "react";
 import "./Palette.css";
+import { countShapes } from "../paletteFormat";
 
 const paletteItemStyles = (currentColor, color) => {
   return {
@@ -25,9 +26,10 @@ const Palette = ({ idList, currentColor, setCurrentColor, colorCount }) => {
   return (
     <div className="palette-container">
       {idList.map((value, idx) => {
-        if (idx === 0) return null;
+        // The image border is not a paint
+        if (value.border) return null;
           {
-            return (colorCount[value.color] / value.shapes.length === 0) ? 
+            return (colorCount[value.color] / countShapes(value.shapes) === 0) ? 
             <img src="/check.png" className="completed-item"/>
             :
             <div
@@ -36,7 +38,7 @@ const Palette = ({ idList, currentColor, setCurrentColor, colorCount }) => {
               style={paletteItemStyles(currentColor, value.color)}
               onClick={() => setCurrentColor(value.color)}
             >
-              <div style={overlayStyles((colorCount[value.color] / value.shapes.length) * 100)} />
+              <div style={overlayStyles((colorCount[value.color] / countShapes(value.shapes)) * 100)} />
               {idx}
             </div>
           }
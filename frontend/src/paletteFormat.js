@@ -0,0 +1,87 @@
+// Collapses a list of shape ids into sorted [start, stop) ranges of consecutive ids
+const getRanges = (ids) => {
+  const ranges = [];
+  for (const id of ids.map(Number).sort((a, b) => a - b)) {
+    const last = ranges[ranges.length - 1];
+    if (last && last[1] === id) {
+      last[1] += 1;
+    } else {
+      ranges.push([id, id + 1]);
+    }
+  }
+  return ranges;
+};
+
+// Reads the palette json written next to an svg. Palettes with a version store the shapes of every color as
+// [start, stop) ranges of ids with optional per shape areas and labels indexed by id, older palettes are a list
+// with the id of every shape and are collapsed into ranges, so the components only ever work with ranges.
+export const decodePalette = (data) => {
+  let palette;
+  if (Array.isArray(data)) {
+    palette = data.map((entry) => ({ ...entry, shapes: getRanges(entry.shapes) }));
+  } else if (data.version === 2) {
+    palette = data.colors.map((entry) => {
+      const decoded = { ...entry };
+      for (const key of ["areas", "labels"]) {
+        if (data[key]) {
+          decoded[key] = data[key];
+        }
+      }
+      return decoded;
+    });
+  } else {
+    throw new Error(`Unknown palette version ${data.version}`);
+  }
+
+  // The image border is flagged with border, palettes written before the flag always put it first
+  if (palette.length && !palette.some((entry) => entry.border)) {
+    palette[0] = { ...palette[0], border: true };
+  }
+  return palette;
+};
+
+// The number of shapes in a list of ranges
+export const countShapes = (ranges) =>
+  ranges.reduce((count, [start, stop]) => count + stop - start, 0);
+
+// Whether a shape id is in a list of sorted ranges, found by binary search
+export const hasShape = (ranges, id) => {
+  let low = 0;
+  let high = ranges.length;
+  while (low < high) {
+    const middle = (low + high) >> 1;
+    if (ranges[middle][1] <= id) {
+      low = middle + 1;
+    } else {
+      high = middle;
+    }
+  }
+  return low < ranges.length && ranges[low][0] <= id;
+};
+
+// The string ids of the shapes in a list of ranges, one at a time
+export function* shapeIds(ranges) {
+  for (const [start, stop] of ranges) {
+    for (let id = start; id < stop; id++) {
+      yield String(id);
+    }
+  }
+}
+
+const paletteMetadata = '<metadata id="pbn-palette">';
+
+// Reads the palette embedded at the end of a bundled svg, or returns null for an svg without one
+export const extractPalette = (svg) => {
+  const start = svg.lastIndexOf(paletteMetadata);
+  if (start === -1) {
+    return null;
+  }
+  const end = svg.indexOf("</metadata>", start);
+  const text = svg
+    .slice(start + paletteMetadata.length, end)
+    .replace(/&lt;/g, "<")
+    .replace(/&gt;/g, ">")
+    .replace(/&amp;/g, "&");
+
+  return decodePalette(JSON.parse(text));
+};
@@ -0,0 +1,49 @@
+import numpy as np
+
+
+def _concatenate_polygons(polygons: list) -> "tuple[np.ndarray, np.ndarray]":
+    """
+    Puts the points of many polygons into one array so they can be measured together
+
+    Arguments:
+        polygons: A list of OpenCV (N, 1, 2) contours or (N, 2) arrays of points
+
+    Returns:
+        (points, starts)
+        points: A (T, 2) float64 array with the points of every polygon one after the other
+        starts: A (P + 1,) array with the index of the first point of every polygon followed by T
+    """
+
+    rings = [np.asarray(polygon).reshape(-1, 2) for polygon in polygons]
+    starts = np.zeros(len(rings) + 1, dtype=np.int64)
+    np.cumsum([len(ring) for ring in rings], out=starts[1:])
+    if starts[-1] == 0:
+        return np.empty((0, 2)), starts
+
+    return np.concatenate(rings).astype(np.float64), starts
+
+
+def polygon_areas(polygons: list) -> np.ndarray:
+    """
+    Computes the area of every polygon with the shoelace formula, all polygons at once
+
+    Arguments:
+        polygons: A list of OpenCV (N, 1, 2) contours or (N, 2) arrays of points
+
+    Returns:
+        areas: A (P,) array with the absolute area of every polygon, 0 for polygons with fewer than 3 points
+    """
+
+    points, starts = _concatenate_polygons(polygons)
+    areas = np.zeros(len(starts) - 1)
+    nonEmpty = np.flatnonzero(starts[:-1] < starts[1:])
+    if len(nonEmpty) == 0:
+        return areas
+
+    # The next point of every point wraps around to the first point of its polygon
+    nextPoints = np.arange(1, len(points) + 1)
+    nextPoints[starts[nonEmpty + 1] - 1] = starts[nonEmpty]
+    cross = points[:, 0] * points[nextPoints, 1] - points[nextPoints, 0] * points[:, 1]
+    areas[nonEmpty] = np.abs(np.add.reduceat(cross, starts[nonEmpty])) / 2
+
+    return areas
@@ -7,13 +7,47 @@ from firebase_admin import initialize_app, storage, credentials
 import numpy as np
 import cv2
 from pbn_gen import PbnGen
+import gzip
 import json
+from contextlib import contextmanager
 
 cred = credentials.Certificate("credentials.json")
 app = initialize_app(cred, {"storageBucket": "paint-by-number-21987.appspot.com"})
 bucket = storage.bucket()
 
 
+def _upload_json(blob, data, compress: bool):
+    """
+    Uploads a json document like the palette, gzipped with a matching content encoding when compress is set
+    """
+
+    data = json.dumps(data).encode("utf-8")
+    if compress:
+        data = gzip.compress(data, mtime=0)
+        blob.content_encoding = "gzip"
+
+    print("uploading json")
+    blob.upload_from_string(data, content_type="application/json")
+
+
+@contextmanager
+def _open_blob(blob, content_type: str, compress: bool):
+    """
+    Opens a binary stream that writes to a blob as it goes, gzipped with a matching content encoding when compress is set
+    """
+
+    if compress:
+        blob.content_encoding = "gzip"
+    with blob.open("wb", content_type=content_type) as blob_stream:
+        if not compress:
+            yield blob_stream
+            return
+        stream = gzip.GzipFile(fileobj=blob_stream, mode="wb", mtime=0)
+        yield stream
+        # Writes the end of the gzip stream, the blob stream stays open
+        stream.close()
+
+
 @https_fn.on_call(memory=options.MemoryOption.GB_1)
 def make_pbn(req: https_fn.CallableRequest):
     object_id = req.data["id"]
@@ -40,24 +74,58 @@ def make_pbn(req: https_fn.CallableRequest):
         nparr = np.frombuffer(contents, np.uint8)
         img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
 
-        pbn = PbnGen(img, num_colors=15)
-        pbn.set_final_pbn()
-        svg_output, palette = pbn.output_to_svg()
-        palette_str = json.dumps(palette)
+        # An optional fixed paint set as a list of [r, g, b] colors, the palette is then picked from these paints
+        paint_set = req.data.get("paintSet")
 
-        svg_blob = bucket.blob(f"{base_id}.svg")
+        pbn = PbnGen(img, num_colors=15, cluster_mode="histogram", paint_set=paint_set)
+        pbn.set_final_pbn()
+        # A smaller svg with one group per color that the canvas recolors in one step
+        compact = bool(req.data.get("compact", False))
+        # The shapes of every color as ranges of ids, the canvas reads this and the older list of every id
+        palette_format = req.data.get("paletteFormat", "ranges")
+        # The palette is embedded in the svg so the canvas loads a single object
+        bundle = bool(req.data.get("bundle", True))
+        # The artifacts are gzipped once here and stored with their content encoding, storage serves them
+        # decompressed to clients that do not accept gzip
+        compress = bool(req.data.get("compress", True))
 
         print("uploading svg")
-        svg_blob.upload_from_string(
-            str.encode(svg_output), content_type="image/svg+xml"
-        )
+        # The svg is streamed to storage as the shapes are written instead of being built in memory first
+        with _open_blob(
+            bucket.blob(f"{base_id}.svg"), "image/svg+xml", compress
+        ) as svg_stream:
+            # The quality knob for the outlines in pixels and whether to write them as Bezier curves, which are
+            # only kept where they take fewer points than the lines so they never grow the svg
+            _, palette = pbn.output_to_svg(
+                simplify_tolerance=req.data.get("simplifyTolerance"),
+                curves=bool(req.data.get("curves", False)),
+                holes=bool(req.data.get("holes", False)),
+                compact=compact,
+                palette_format=palette_format,
+                shape_metadata=bool(req.data.get("shapeMetadata", False)),
+                embed_palette=bundle,
+                stream=svg_stream,
+            )
 
-        json_blob = bucket.blob(f"{base_id}.json")
+        # The palette is only known once the svg is written
+        if not bundle:
+            _upload_json(bucket.blob(f"{base_id}.json"), palette, compress)
 
-        print("uploading json")
-        json_blob.upload_from_string(
-            str.encode(palette_str), content_type="application/json"
-        )
+        # The number of levels of an optional pyramid of svg tiles for very large images, written next to the svg
+        # under {base_id}_tiles with an index.json that lists the tiles of every level
+        tiles = int(req.data.get("tiles", 0))
+        if tiles > 0:
+            print("uploading tiles")
+            index = pbn.output_to_tiles(
+                lambda file_name: _open_blob(
+                    bucket.blob(f"{base_id}_tiles/{file_name}"),
+                    "image/svg+xml",
+                    compress,
+                ),
+                levels=tiles,
+                simplify_tolerance=req.data.get("simplifyTolerance"),
+            )
+            _upload_json(bucket.blob(f"{base_id}_tiles/index.json"), index, compress)
     except Exception as e:
         print(e)
         raise https_fn.HttpsError(
@@ -1,21 +1,56 @@
 from src.pbn_gen import PbnGen
-import sys
+import argparse
+import gzip
+import json
 import os
 
 
 def main():
-    if not len(sys.argv) == 2:
-        print("Error: No input image provided")
-        exit(1)
+    parser = argparse.ArgumentParser(
+        description="Generates a paint by number svg and palette next to an image"
+    )
+    parser.add_argument("input_image", help="The image to generate from")
+    parser.add_argument(
+        "--bundle",
+        action="store_true",
+        help="Write a single pbn.svg with the palette embedded instead of pbn.svg and pbn.json",
+    )
+    parser.add_argument(
+        "--compress",
+        action="store_true",
+        help="Gzip the output to pbn.svg.gz and pbn.json.gz, to be served with Content-Encoding: gzip",
+    )
+    parser.add_argument(
+        "--tiles",
+        type=int,
+        metavar="LEVELS",
+        help="Also write a pyramid of svg tiles with this many levels of detail to pbn_tiles",
+    )
+    args = parser.parse_args()
 
-    input_image = sys.argv[1]
+    input_image = args.input_image
     dir_name = os.path.dirname(input_image)
     try:
         pbn = PbnGen(input_image)
         pbn.set_final_pbn()
-        pbn.output_to_svg(
-            os.path.join(dir_name, "pbn.svg"), os.path.join(dir_name, "pbn.json")
+        svg_path = os.path.join(dir_name, "pbn.svg")
+        json_path = os.path.join(dir_name, "pbn.json")
+        options = (
+            {"palette_format": "ranges", "embed_palette": True} if args.bundle else {}
         )
+        if args.compress:
+            # The svg is compressed as it is written, mtime 0 gives the same file for the same template
+            with gzip.GzipFile(svg_path + ".gz", "wb", mtime=0) as svg_stream:
+                palette = pbn.output_to_svg(svg_stream, **options)
+            if not args.bundle:
+                with gzip.GzipFile(json_path + ".gz", "wb", mtime=0) as json_stream:
+                    json_stream.write(json.dumps(palette).encode("utf-8"))
+        elif args.bundle:
+            pbn.output_to_svg(svg_path, **options)
+        else:
+            pbn.output_to_svg(svg_path, json_path)
+        if args.tiles:
+            pbn.output_to_tiles(os.path.join(dir_name, "pbn_tiles"), levels=args.tiles)
     except Exception as e:
         print("error generating PBN - make sure the image exists")
         print(e)
@@ -0,0 +1,243 @@
+import numpy as np
+
+
+def assign_labels(
+    X: np.ndarray, centers: np.ndarray, chunk_size: int = 65536
+) -> "tuple[np.ndarray, np.ndarray]":
+    """
+    Assigns every point to its nearest center. The distances are computed for chunk_size points at a time
+    so memory stays bounded by chunk_size * K instead of N * K.
+
+    Arguments:
+        X: A (N, D) array of points
+        centers: A (K, D) array of centers
+        chunk_size: How many points are compared against the centers at once
+
+    Returns:
+        (labels, sq_distances)
+        labels: A (N,) int32 array with the index of the nearest center for each point
+        sq_distances: A (N,) float32 array with the squared distance of each point to its nearest center
+    """
+
+    centers = np.asarray(centers, dtype=np.float32)
+    center_norms = np.einsum("ij,ij->i", centers, centers)
+
+    labels = np.empty(len(X), dtype=np.int32)
+    sq_distances = np.empty(len(X), dtype=np.float32)
+    for start in range(0, len(X), chunk_size):
+        chunk = np.asarray(X[start : start + chunk_size], dtype=np.float32)
+        # |x - c|^2 = |x|^2 - 2x.c + |c|^2 where |x|^2 is the same for every center and is only added back for the minimum
+        distances = center_norms - 2 * chunk @ centers.T
+        chunk_labels = np.argmin(distances, axis=1)
+
+        labels[start : start + chunk_size] = chunk_labels
+        sq_distances[start : start + chunk_size] = np.maximum(
+            distances[np.arange(len(chunk)), chunk_labels]
+            + np.einsum("ij,ij->i", chunk, chunk),
+            0,
+        )
+
+    return labels, sq_distances
+
+
+class KMeans:
+    """
+    A small float32 K means implementation on NumPy with the subset of the sklearn.cluster.KMeans interface PbnGen uses.
+    It uses k-means++ initialization, Lloyd iterations with chunked distance computations and a deterministic seed,
+    so PbnGen can cluster colors without importing sklearn.
+    """
+
+    def __init__(
+        self,
+        n_clusters: int = 8,
+        init="k-means++",
+        n_init="auto",
+        max_iter: int = 300,
+        tol: float = 1e-4,
+        random_state=None,
+        chunk_size: int = 65536,
+    ):
+        """
+        Arguments:
+            n_clusters: The number of clusters to fit
+            init: "k-means++" or a (n_clusters, D) array of initial centers
+            n_init: How many k-means++ initializations to run keeping the lowest inertia. "auto" runs one, like sklearn.
+                Ignored when init is an array.
+            max_iter: The maximum number of Lloyd iterations per run
+            tol: Convergence tolerance on the squared center shift, relative to the mean variance of the data like sklearn
+            random_state: An integer seed for reproducible results or None
+            chunk_size: How many points are compared against the centers at once
+        """
+
+        self.n_clusters = n_clusters
+        self.init = init
+        self.n_init = n_init
+        self.max_iter = max_iter
+        self.tol = tol
+        self.random_state = random_state
+        self.chunk_size = chunk_size
+
+    def fit(self, X: np.ndarray, sample_weight: np.ndarray = None) -> "KMeans":
+        """
+        Fits the centers to X and stores cluster_centers_, labels_, inertia_ and n_iter_
+
+        Arguments:
+            X: A (N, D) array of points
+            sample_weight: An optional (N,) array of weights for each point, e.g. pixel counts of histogram bins
+
+        Returns:
+            self
+        """
+
+        X = np.asarray(X, dtype=np.float32)
+        weights = (
+            np.ones(len(X), dtype=np.float64)
+            if sample_weight is None
+            else np.asarray(sample_weight, dtype=np.float64)
+        )
+        rng = np.random.default_rng(self.random_state)
+
+        # The tolerance is relative to the data like in sklearn
+        tol = self.tol * np.mean(np.var(X, axis=0))
+
+        if isinstance(self.init, str):
+            num_runs = 1 if self.n_init == "auto" else self.n_init
+            initial_centers = [
+                self._init_centers(X, weights, rng) for _ in range(num_runs)
+            ]
+        else:
+            initial_centers = [np.array(self.init, dtype=np.float32)]
+
+        best = None
+        for centers in initial_centers:
+            result = self._lloyd(X, weights, centers, tol)
+            if best is None or result[2] < best[2]:
+                best = result
+
+        (
+            self.cluster_centers_,
+            self.labels_,
+            self.inertia_,
+            self.n_iter_,
+        ) = best
+        return self
+
+    def transform(self, X: np.ndarray) -> np.ndarray:
+        """
+        Returns the (N, K) distances from every point in X to every center
+        """
+
+        X = np.asarray(X, dtype=np.float32)
+        centers = self.cluster_centers_.astype(np.float32)
+        sq_distances = (
+            np.einsum("ij,ij->i", X, X)[:, np.newaxis]
+            - 2 * X @ centers.T
+            + np.einsum("ij,ij->i", centers, centers)
+        )
+        return np.sqrt(np.maximum(sq_distances, 0))
+
+    def predict(self, X: np.ndarray) -> np.ndarray:
+        """
+        Returns the index of the nearest center for every point in X
+        """
+
+        return assign_labels(X, self.cluster_centers_, self.chunk_size)[0]
+
+    def _init_centers(
+        self, X: np.ndarray, weights: np.ndarray, rng: np.random.Generator
+    ) -> np.ndarray:
+        """
+        Greedy k-means++ initialization: every new center is the best of a few candidates sampled proportionally to
+        their weighted squared distance to the centers chosen so far
+        """
+
+        num_local_trials = 2 + int(np.log(self.n_clusters))
+
+        centers = np.empty((self.n_clusters, X.shape[1]), dtype=np.float32)
+        centers[0] = X[rng.choice(len(X), p=weights / weights.sum())]
+
+        closest_sq_distances = ((X - centers[0]) ** 2).sum(axis=1)
+        current_potential = (closest_sq_distances * weights).sum()
+
+        for c in range(1, self.n_clusters):
+            if current_potential <= 0:
+                # Fewer distinct points than clusters, the remaining centers are duplicates
+                centers[c:] = centers[0]
+                break
+
+            cumulative = np.cumsum(closest_sq_distances * weights)
+            candidate_ids = np.searchsorted(
+                cumulative, rng.uniform(size=num_local_trials) * current_potential
+            )
+            candidate_ids = np.minimum(candidate_ids, len(X) - 1)
+
+            best_candidate = None
+            for candidate_id in candidate_ids:
+                candidate_sq_distances = np.minimum(
+                    closest_sq_distances, ((X - X[candidate_id]) ** 2).sum(axis=1)
+                )
+                candidate_potential = (candidate_sq_distances * weights).sum()
+                if best_candidate is None or candidate_potential < best_candidate[1]:
+                    best_candidate = (
+                        candidate_id,
+                        candidate_potential,
+                        candidate_sq_distances,
+                    )
+
+            centers[c] = X[best_candidate[0]]
+            current_potential = best_candidate[1]
+            closest_sq_distances = best_candidate[2]
+
+        return centers
+
+    def _lloyd(
+        self, X: np.ndarray, weights: np.ndarray, centers: np.ndarray, tol: float
+    ) -> "tuple[np.ndarray, np.ndarray, float, int]":
+        """
+        Runs Lloyd iterations from the given centers until the squared center shift is at most tol
+
+        Returns:
+            (centers, labels, inertia, n_iter)
+        """
+
+        centers = centers.astype(np.float64)
+        labels = None
+
+        for n_iter in range(1, self.max_iter + 1):
+            new_labels, sq_distances = assign_labels(X, centers, self.chunk_size)
+
+            if labels is not None and np.array_equal(labels, new_labels):
+                break
+            labels = new_labels
+
+            counts = np.bincount(labels, weights=weights, minlength=self.n_clusters)
+            sums = np.stack(
+                [
+                    np.bincount(
+                        labels, weights=weights * X[:, d], minlength=self.n_clusters
+                    )
+                    for d in range(X.shape[1])
+                ],
+                axis=1,
+            )
+
+            new_centers = centers.copy()
+            non_empty = counts > 0
+            new_centers[non_empty] = sums[non_empty] / counts[non_empty, np.newaxis]
+
+            # Relocate empty clusters to the points furthest from their centers
+            empty = np.flatnonzero(~non_empty)
+            if len(empty) > 0:
+                furthest = np.argsort(sq_distances)[-len(empty) :]
+                new_centers[empty] = X[furthest]
+
+            shift = ((new_centers - centers) ** 2).sum()
+            centers = new_centers
+            if shift <= tol:
+                break
+
+        # Make the labels and inertia consistent with the final centers
+        labels, sq_distances = assign_labels(X, centers, self.chunk_size)
+        inertia = float((sq_distances * weights).sum())
+
+        return centers, labels, inertia, n_iter
@@ -0,0 +1,123 @@
+import json
+import re
+from xml.sax.saxutils import unescape
+
+PALETTE_VERSION = 2
+# The id of the metadata element output_to_svg writes the palette into with embed_palette
+PALETTE_METADATA_ID = "pbn-palette"
+
+
+def _get_ranges(ids: list) -> list:
+    """
+    Collapses shape ids into runs of consecutive ids
+
+    Arguments:
+        ids: A list of integer shape ids, or their strings
+
+    Returns:
+        ranges: A list of [start, stop] pairs, each covering the ids start up to but not including stop
+    """
+
+    ranges = []
+    for shapeId in map(int, ids):
+        if ranges and ranges[-1][1] == shapeId:
+            ranges[-1][1] += 1
+        else:
+            ranges.append([shapeId, shapeId + 1])
+
+    return ranges
+
+
+def encode_palette(palette: list, areas: list = None, labels: list = None) -> dict:
+    """
+    Encodes a palette from output_to_svg with the shapes of every color as ranges of ids instead of lists of every id.
+    The ids of a color are consecutive, so every color takes about the same space however many shapes it has.
+
+    Arguments:
+        palette: A list of palette entries each with a "color" and the string ids of its "shapes", any other keys like
+            "group" are kept
+        areas=None: The area in pixels of every shape, indexed by shape id
+        labels=None: The [x, y] position of the label of every shape, indexed by shape id
+
+    Returns:
+        data: A dictionary with the version, an entry for every color with the ranges of its "shapes" and the optional
+            per shape "areas" and "labels"
+    """
+
+    data = {
+        "version": PALETTE_VERSION,
+        "colors": [
+            {**entry, "shapes": _get_ranges(entry["shapes"])} for entry in palette
+        ],
+    }
+    if areas is not None:
+        data["areas"] = list(areas)
+    if labels is not None:
+        data["labels"] = list(labels)
+
+    return data
+
+
+def decode_palette(data) -> list:
+    """
+    Decodes a palette written by encode_palette, or passes through a palette in the original format, a list of entries
+    with the string id of every shape
+
+    Arguments:
+        data: The parsed palette json in either format
+
+    Returns:
+        palette: A list of palette entries each with a "color" and the string ids of its "shapes", plus the "areas" and
+            "labels" of its shapes when the palette has them
+    """
+
+    if isinstance(data, list):
+        return data
+
+    assert (
+        data.get("version") == PALETTE_VERSION
+    ), f"Unknown palette version {data.get('version')}!"
+
+    palette = []
+    for entry in data["colors"]:
+        ids = [
+            shapeId for start, stop in entry["shapes"] for shapeId in range(start, stop)
+        ]
+        decoded = {**entry, "shapes": [str(shapeId) for shapeId in ids]}
+        for key in ("areas", "labels"):
+            if key in data:
+                decoded[key] = [data[key][shapeId] for shapeId in ids]
+        palette.append(decoded)
+
+    return palette
+
+
+def extract_palette(svg: str) -> list:
+    """
+    Reads the palette embedded in an svg written with embed_palette
+
+    Arguments:
+        svg: The text of the svg
+
+    Returns:
+        palette: The decoded palette, see decode_palette, or None if the svg has no palette
+    """
+
+    match = re.search(
+        f'<metadata id="{PALETTE_METADATA_ID}">(.*?)</metadata>', svg, re.DOTALL
+    )
+    if match is None:
+        return None
+
+    return decode_palette(json.loads(unescape(match.group(1))))
+
+
+def load_palette(path: str) -> list:
+    """
+    Reads a palette json file in either format, see decode_palette, or the palette embedded in an svg file
+    """
+
+    with open(path, encoding="utf-8") as infile:
+        if path.endswith(".svg"):
+            return extract_palette(infile.read())
+        return decode_palette(json.load(infile))
@@ -1,14 +1,16 @@
 import cv2
-from collections import Counter
 import numpy as np
 import matplotlib.pyplot as plt
-from sklearn.cluster import KMeans
 from kneed import KneeLocator
-from sklearn.utils import shuffle
-from shapely.geometry import Polygon, Point
-import svgwrite
 import json
-import random
+import os
+import time
+import heapq
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from src.kmeans import KMeans as NumpyKMeans, assign_labels
+from src.svg_writer import SvgWriter
+from src.palette_json import encode_palette, PALETTE_METADATA_ID
 
 # Change me to an integer for consistent results between runs, or set to None to allow randomness in K-means
 random_state = None
@@ -16,7 +18,18 @@ random_state = None
 
 class PbnGen:
     def __init__(
-        self, f_name, num_colors=None, min_num_colors=10, pruningThreshold=6.25e-5
+        self,
+        f_name,
+        num_colors=None,
+        min_num_colors=10,
+        pruningThreshold=6.25e-5,
+        cluster_mode="full",
+        cluster_sample_size=50000,
+        lut_bits=None,
+        kmeans_backend="sklearn",
+        paint_set=None,
+        init_palette=None,
+        palette_drift_threshold=4.0,
     ):
         bgr_image = cv2.imread(f_name)
         # change to RGB
@@ -32,18 +45,478 @@ class PbnGen:
         # The minimum percentage of the image's area a color cluster can be before getting absorbed by surrounding colors
         self.pruningThreshold = pruningThreshold
 
-        # This will contain a dict of colors and binary masks of the pruned clusters
+        # This will contain a dict of palette indices and label masks of the pruned clusters
         self.prunableClusters = None
+        self.prunableClusterStats = None
+
+        # A list with a record of every pass of the last pruning run, see pruneClustersSimple
+        self.pruningReport = None
+
+        # The points of the outlines before and after simplification in the last output_to_svg, see _simplifyOutlines
+        self.geometryReport = None
+
+        # The fraction of the image no shape paints in the last output_to_svg with check_coverage
+        self.uncoveredFraction = None
+
+        # How the palette is fit: "full" fits K means on every pixel, "histogram" fits on the weighted color histogram
+        # of the image and "sample" fits on a fixed size stratified sample of cluster_sample_size pixels.
+        # The summary modes then assign every pixel to its nearest center in chunks
+        assert cluster_mode in (
+            "full",
+            "histogram",
+            "sample",
+        ), f"Unknown cluster_mode {cluster_mode}!"
+        self.cluster_mode = cluster_mode
+        self.cluster_sample_size = cluster_sample_size
+
+        # When set, pixels are assigned to the palette through a (2**lut_bits)^3 RGB lookup table instead of
+        # computing their distance to every center, only pixels in bins on a boundary between centers are
+        # computed exactly. 6 bits works well.
+        self.lut_bits = lut_bits
+
+        # The last built lookup table as (key, table) so re-applying the same palette does not rebuild it
+        self.paletteLUT = None
+
+        # "sklearn" or "numpy", the K means implementation used by cluster_colors and get_num_clusters.
+        # The numpy backend is self contained so sklearn is never imported, which matters for cold starts.
+        assert kmeans_backend in (
+            "sklearn",
+            "numpy",
+        ), f"Unknown kmeans_backend {kmeans_backend}!"
+        self.kmeans_backend = kmeans_backend
+
+        # Seconds spent fitting the palette and assigning pixels to it during the last clustering
+        self.clusterTimings = None
+
+        # A fixed set of paints as a (P, 3) array of RGB colors from 0 to 255. When set, the palette is made of these paints
+        # instead of being clustered: all of them, or the num_colors paints that best cover the image when num_colors is
+        # smaller than the set. get_num_clusters and K means are never run.
+        self.paintSet = (
+            None
+            if paint_set is None
+            else np.asarray(paint_set, dtype=np.uint8).reshape(-1, 3)
+        )
 
-        self.num_colors = num_colors if num_colors else self.get_num_clusters()
-        # make sure number of colors is at least minimum number
-        self.num_colors = (
-            self.num_colors + min_num_colors
-            if self.num_colors < min_num_colors
-            else self.num_colors
+        # A (K, 3) array of RGB colors from 0 to 255 to warm start clustering from, e.g. the palette of a previous similar
+        # image as pbn.palette * 255. num_colors is taken from its length. When the palette would move by at most
+        # palette_drift_threshold in a single K means step on this image it is reused as is without fitting.
+        self.initPalette = (
+            None
+            if init_palette is None
+            else np.asarray(init_palette, dtype=np.float64).reshape(-1, 3)
         )
+        self.paletteDriftThreshold = palette_drift_threshold
+
+        # How far the initial palette moved in a single K means step on the last clustered image
+        self.paletteDrift = None
+
+        if self.paintSet is not None:
+            self.num_colors = (
+                min(num_colors, len(self.paintSet))
+                if num_colors
+                else len(self.paintSet)
+            )
+        elif self.initPalette is not None:
+            self.num_colors = len(self.initPalette)
+        else:
+            self.num_colors = num_colors if num_colors else self.get_num_clusters()
+            # make sure number of colors is at least minimum number
+            self.num_colors = (
+                self.num_colors + min_num_colors
+                if self.num_colors < min_num_colors
+                else self.num_colors
+            )
         print(f"Quantized to {self.num_colors} colors")
 
+    def _fit_palette(self):
+        """
+        Performs K means clustering on the image and stores the resulting palette and per pixel labels in
+        self.palette and self.labels
+        """
+
+        if self.paintSet is not None:
+            self._fitPaintSet()
+            return
+
+        startTime = time.time()
+
+        fitPixels, sampleWeight = self._getClusterSummary()
+        labels = None
+
+        if self.initPalette is not None:
+            self.paletteDrift, fitLabels = self._getPaletteDrift(
+                fitPixels, sampleWeight, self.initPalette
+            )
+            print(f"Initial palette drifted by {self.paletteDrift:.2f}")
+
+        if (
+            self.initPalette is not None
+            and self.paletteDriftThreshold is not None
+            and self.paletteDrift <= self.paletteDriftThreshold
+        ):
+            # The image barely changes the palette, reuse it without fitting
+            centers = self.initPalette
+            if fitPixels is self.img1d:
+                labels = fitLabels
+        else:
+            KMeans = self._getKMeans()
+            if self.initPalette is not None:
+                # Starting from a close palette converges in a couple of Lloyd iterations
+                model = KMeans(
+                    n_clusters=self.num_colors, init=self.initPalette, n_init=1
+                )
+            else:
+                model = KMeans(
+                    n_clusters=self.num_colors,
+                    n_init="auto",
+                    random_state=random_state,
+                )
+
+            if fitPixels is self.img1d:
+                model.fit(self.img1d)
+                # The labels of every pixel come for free when fitting on the full image
+                labels = model.labels_
+            else:
+                model.fit(fitPixels, sample_weight=sampleWeight)
+            centers = model.cluster_centers_
+
+        fitTime = time.time() - startTime
+
+        if labels is None:
+            if self.lut_bits:
+                labels = self._assignLabelsLUT(self.img1d, centers, self.lut_bits)
+            else:
+                labels = self._assignLabels(self.img1d, centers)
+
+        assignTime = time.time() - startTime - fitTime
+        self.clusterTimings = {"fit": fitTime, "assign": assignTime}
+        print(
+            f"Palette fit took {fitTime:.2f}s, pixel assignment took {assignTime:.2f}s"
+        )
+
+        # get primary colors as floats from 0 to 1
+        self.palette = centers / 255
+        self.labels = labels
+
+    def _getPaletteDrift(
+        self, pixels: np.ndarray, weights: np.ndarray, centers: np.ndarray
+    ) -> "tuple[float, np.ndarray]":
+        """
+        Measures how far a palette would move in a single K means step on the given pixels
+
+        Arguments:
+            pixels: A (N, 3) array of colors
+            weights: A (N,) array with the number of pixels each color represents, or None if every color counts once
+            centers: A (K, 3) array of RGB colors from 0 to 255
+
+        Returns:
+            (drift, labels)
+            drift: The largest distance a center moves, or infinity if a center gets no pixels
+            labels: A (N,) array with the index of the nearest center for each pixel
+        """
+
+        labels = self._assignLabels(pixels, centers)
+        if weights is None:
+            weights = np.ones(len(pixels))
+
+        counts = np.bincount(labels, weights=weights, minlength=len(centers))
+        if np.any(counts == 0):
+            return np.inf, labels
+
+        means = (
+            np.stack(
+                [
+                    np.bincount(
+                        labels, weights=weights * pixels[:, c], minlength=len(centers)
+                    )
+                    for c in range(3)
+                ],
+                axis=1,
+            )
+            / counts[:, np.newaxis]
+        )
+
+        return float(np.sqrt(((means - centers) ** 2).sum(axis=1)).max()), labels
+
+    def _fitPaintSet(self):
+        """
+        Takes the palette from self.paintSet instead of clustering and assigns every pixel to its nearest paint, storing
+        the results in self.palette and self.labels like _fit_palette
+        """
+
+        startTime = time.time()
+
+        paints = self.paintSet
+        if self.num_colors < len(paints):
+            paints = paints[self.selectPaints(paints, self.num_colors)]
+
+        fitTime = time.time() - startTime
+        labels = self._assignLabelsLUT(self.img1d, paints, self.lut_bits or 6)
+
+        assignTime = time.time() - startTime - fitTime
+        self.clusterTimings = {"fit": fitTime, "assign": assignTime}
+        print(
+            f"Paint selection took {fitTime:.2f}s, pixel assignment took {assignTime:.2f}s"
+        )
+
+        self.palette = paints / 255
+        self.labels = labels
+
+    def selectPaints(self, paintSet: np.ndarray, numPaints: int) -> np.ndarray:
+        """
+        Greedily picks the numPaints paints of a paint set that best reproduce the image. Each step adds the paint that
+        lowers the total squared distance from the pixels to their nearest chosen paint the most. The pixels are
+        summarized by their color histogram so the cost does not depend on the image size.
+
+        Arguments:
+            paintSet: A (P, 3) array of RGB colors from 0 to 255
+            numPaints: How many paints to pick
+
+        Returns:
+            indices: A sorted (numPaints,) array with the indices of the chosen paints in paintSet
+        """
+
+        colors, counts = self._getColorHistogram(self.img1d, bits=5)
+        paints = np.asarray(paintSet, dtype=np.float32)
+        colors = colors.astype(np.float32)
+
+        # (M, P) squared distances from every histogram color to every paint
+        sqDistances = np.maximum(
+            np.einsum("ij,ij->i", colors, colors)[:, np.newaxis]
+            - 2 * colors @ paints.T
+            + np.einsum("ij,ij->i", paints, paints),
+            0,
+        )
+        weights = counts.astype(np.float32)
+
+        chosen = []
+        closestSqDistances = np.full(len(colors), np.inf, dtype=np.float32)
+        for _ in range(numPaints):
+            costs = weights @ np.minimum(closestSqDistances[:, np.newaxis], sqDistances)
+            costs[chosen] = np.inf
+            best = int(np.argmin(costs))
+
+            chosen.append(best)
+            closestSqDistances = np.minimum(closestSqDistances, sqDistances[:, best])
+
+        return np.sort(chosen)
+
+    def _getClusterSummary(self) -> "tuple[np.ndarray, np.ndarray]":
+        """
+        Summarizes the pixels of the image into a compact set of colors to fit the palette on according to self.cluster_mode
+
+        Returns:
+            (colors, weights)
+            colors: A (M, 3) array of colors to fit on. This is self.img1d itself in the "full" mode or when the summary
+                would have fewer colors than clusters.
+            weights: A (M,) array with the number of pixels each color represents, or None if every color counts once
+        """
+
+        colors, weights = self.img1d, None
+
+        if self.cluster_mode == "histogram":
+            colors, weights = self._getColorHistogram(self.img1d)
+        elif self.cluster_mode == "sample":
+            colors = self._getStratifiedSample(self.img1d, self.cluster_sample_size)
+
+        if len(colors) < self.num_colors:
+            return self.img1d, None
+
+        return colors, weights
+
+    def _getColorHistogram(
+        self, pixels: np.ndarray, bits: int = 6
+    ) -> "tuple[np.ndarray, np.ndarray]":
+        """
+        Bins the pixels into a 3D color histogram with 2**bits bins per channel. The histogram size is bounded no matter how
+        large the image is, and for smooth (blurred) images most bins are empty.
+
+        Arguments:
+            pixels: A (N, 3) uint8 array of colors
+            bits: How many of the most significant bits of each channel are used to pick the bin
+
+        Returns:
+            (colors, counts)
+            colors: A (M, 3) float array with the mean color of each non empty bin
+            counts: A (M,) array with the number of pixels in each non empty bin
+        """
+
+        pixels = pixels.astype(np.uint8, copy=False)
+        binned = pixels >> (8 - bits)
+        binIndices = (
+            (binned[:, 0].astype(np.int32) << (2 * bits))
+            | (binned[:, 1].astype(np.int32) << bits)
+            | binned[:, 2]
+        )
+
+        numBins = 1 << (3 * bits)
+        counts = np.bincount(binIndices, minlength=numBins)
+        occupied = np.flatnonzero(counts)
+
+        # Use the mean color of each bin rather than its center so no precision is lost where colors are sparse
+        colorSums = np.stack(
+            [
+                np.bincount(binIndices, weights=pixels[:, c], minlength=numBins)[
+                    occupied
+                ]
+                for c in range(3)
+            ],
+            axis=1,
+        )
+
+        return colorSums / counts[occupied, np.newaxis], counts[occupied]
+
+    def _getStratifiedSample(self, pixels: np.ndarray, numSamples: int) -> np.ndarray:
+        """
+        Draws one random pixel from each of numSamples equally sized strata of the pixels in raster order,
+        so the sample covers the whole image and costs the same for any image size
+
+        Arguments:
+            pixels: A (N, C) array of pixels
+            numSamples: How many pixels to sample
+
+        Returns:
+            sample: A (min(N, numSamples), C) array of pixels
+        """
+
+        numPixels = len(pixels)
+        if numPixels <= numSamples:
+            return pixels
+
+        rng = np.random.default_rng(random_state)
+
+        strataStarts = np.arange(numSamples, dtype=np.int64) * numPixels // numSamples
+        strataSizes = np.diff(np.append(strataStarts, numPixels))
+        indices = strataStarts + (rng.random(numSamples) * strataSizes).astype(np.int64)
+
+        return pixels[indices]
+
+    def _assignLabels(
+        self, pixels: np.ndarray, centers: np.ndarray, chunkSize: int = 65536
+    ) -> np.ndarray:
+        """
+        Assigns every pixel to its nearest center. The distances are computed for chunkSize pixels at a time
+        so memory stays bounded by chunkSize * K instead of N * K.
+
+        Arguments:
+            pixels: A (N, 3) array of colors
+            centers: A (K, 3) array of cluster centers
+
+        Returns:
+            labels: A (N,) array with the index of the nearest center for each pixel
+        """
+
+        return assign_labels(pixels, centers, chunkSize)[0]
+
+    def _getKMeans(self) -> type:
+        """
+        Returns the K means class of self.kmeans_backend. sklearn is only imported when its backend is used.
+        """
+
+        if self.kmeans_backend == "sklearn":
+            from sklearn.cluster import KMeans
+
+            return KMeans
+
+        return NumpyKMeans
+
+    def buildPaletteLUT(self, centers: np.ndarray, bits: int = 6) -> np.ndarray:
+        """
+        Builds a lookup table from quantized RGB values to the index of the nearest center. Every channel is split into
+        2**bits bins and each bin maps to a center only if that center is the nearest one for every color inside the bin,
+        bins that straddle a boundary between centers are marked with -1 and their pixels are refined exactly.
+
+        Arguments:
+            centers: A (K, 3) array of RGB colors
+            bits: How many of the most significant bits of each channel index the table
+
+        Returns:
+            lut: A ((2**bits)**3,) int16 array of center indices, or -1 for bins near a boundary
+        """
+
+        centers = np.asarray(centers, dtype=np.float64)
+        binSize = 256 >> bits
+
+        # Every integer color in a bin is within radius of the bin center
+        binCenters = np.arange(1 << bits) * binSize + (binSize - 1) / 2
+        radius = np.sqrt(3) * (binSize - 1) / 2
+
+        grid = np.stack(
+            np.meshgrid(binCenters, binCenters, binCenters, indexing="ij"), axis=-1
+        ).reshape(-1, 3)
+        sqDistances = (
+            np.einsum("ij,ij->i", grid, grid)[:, np.newaxis]
+            - 2 * grid @ centers.T
+            + np.einsum("ij,ij->i", centers, centers)
+        )
+
+        lut = np.argmin(sqDistances, axis=1).astype(np.int16)
+        if len(centers) > 1:
+            nearest = np.sqrt(
+                np.maximum(np.partition(sqDistances, 1, axis=1)[:, :2], 0)
+            )
+            # By the triangle inequality the nearest center cannot change within the bin when the gap to the
+            # second nearest center is larger than the bin diameter
+            lut[nearest[:, 1] - nearest[:, 0] <= 2 * radius] = -1
+
+        return lut
+
+    def _assignLabelsLUT(
+        self, pixels: np.ndarray, centers: np.ndarray, bits: int = 6
+    ) -> np.ndarray:
+        """
+        Assigns every pixel to its nearest center with a single gather from the lookup table of buildPaletteLUT.
+        Pixels falling in bins near a boundary between centers are assigned exactly, so the result matches _assignLabels.
+        The table for the last used centers is kept in self.paletteLUT.
+
+        Arguments:
+            pixels: A (N, 3) uint8 array of colors
+            centers: A (K, 3) array of cluster centers
+            bits: How many bits per channel the lookup table uses
+
+        Returns:
+            labels: A (N,) array with the index of the nearest center for each pixel
+        """
+
+        key = (np.asarray(centers, dtype=np.float64).tobytes(), bits)
+        if self.paletteLUT is None or self.paletteLUT[0] != key:
+            self.paletteLUT = (key, self.buildPaletteLUT(centers, bits))
+        lut = self.paletteLUT[1]
+
+        binned = pixels.astype(np.uint8, copy=False) >> (8 - bits)
+        binIndices = (
+            (binned[:, 0].astype(np.int32) << (2 * bits))
+            | (binned[:, 1].astype(np.int32) << bits)
+            | binned[:, 2]
+        )
+
+        labels = lut[binIndices].astype(np.int32)
+
+        ambiguous = np.flatnonzero(labels < 0)
+        if len(ambiguous) > 0:
+            labels[ambiguous] = self._assignLabels(pixels[ambiguous], centers)
+
+        return labels
+
+    def applyPalette_(self, colorPalette: np.ndarray, bits: int = 6):
+        """
+        Quantizes the current image in place to an existing palette without clustering, for example to re-apply the palette
+        of a previous run to a new or resized image. Pixels are assigned through a lookup table so the cost per pixel is
+        close to constant.
+
+        Arguments:
+            colorPalette: A (K, 3) array of RGB colors from 0 to 255
+            bits: How many bits per channel the lookup table uses
+        """
+
+        colorPalette = np.asarray(colorPalette, dtype=np.uint8)
+        labels = self._assignLabelsLUT(self.img1d, colorPalette, bits)
+
+        self.palette = colorPalette / 255
+        self.labels = labels
+
+        self.setLabelMap(labels.reshape(self.image.shape[:2]), colorPalette)
+
     def cluster_colors(self) -> "tuple[np.ndarray, np.ndarray, np.ndarray]":
         """
         Performs K means clustering on the image to quantize it to a fixed number of colors.
@@ -56,62 +529,128 @@ class PbnGen:
             q_img: A (H, W, 3) quantized image which holds the original image quantized to the specified number of colors.
         """
 
-        model = KMeans(
-            n_clusters=self.num_colors, n_init="auto", random_state=random_state
-        )
-        model.fit(self.img1d)
-
-        # get primary colors as floats from 0 to 1
-        self.palette = model.cluster_centers_ / 255
-        self.labels = model.labels_
+        self._fit_palette()
         # get quantized image
         q_img = self.palette[self.labels].reshape(self.image.shape)
         return self.palette, self.labels, q_img
 
     def cluster_colors_(self):
         """
-        An in-place clustering of colors, replaces existing image with the quantized version
+        An in-place clustering of colors, replaces existing image with the quantized version and stores
+        the label map and palette as the canonical state of the image
         """
 
-        colors, labels, q_img = self.cluster_colors()
-        q_img = (q_img * 255).astype(np.uint8)
-        # print(q_img.dtype)
+        self._fit_palette()
+        # Convert the palette rather than the per pixel quantized image, the label map indexes into it
+        colorPalette = (self.palette * 255).astype(np.uint8)
 
-        self.setImage(q_img.copy())
+        self.setLabelMap(self.labels.reshape(self.image.shape[:2]), colorPalette)
 
-    def get_num_clusters(self):
+    def get_num_clusters(
+        self,
+        max_test=25,
+        num_samples=10000,
+        tol=0.01,
+        patience=3,
+        n_jobs=1,
+        return_inertias=False,
+    ):
         """
-        Algorithmically gets optimal number of clusters for k means using knee method
+        Algorithmically gets optimal number of clusters for k means using knee method.
+        The pixel sample is drawn once and each k is warm started from the centers of k - 1 plus one new center.
+        The sweep stops once the knee is clearly past, and the k values that were skipped are given the last inertia
+        so the knee is located over the same range of k as a full sweep.
+
+        Arguments:
+            max_test=25: The k values 1 to max_test - 1 are tested
+            num_samples=10000: How many pixels the sweep is run on
+            tol=0.01: A k value barely helps if it lowers the inertia by less than this fraction of the single cluster inertia
+            patience=3: The sweep stops after this many consecutive k values barely helped
+            n_jobs=1: When greater than 1, evaluates this many k values at a time in parallel threads. The parallel fits
+                are independent so they are not warm started.
+            return_inertias=False: Whether to also return the inertia curve of the evaluated k values
 
         Returns:
             numClusters: The optimal number of clusters found by the K Knee method
+            (numClusters, kValues, inertias) instead when return_inertias is True
         """
 
-        max_test = 25
-        num_samples = 10000
+        # run on sample to save time for approximation
+        sample = self._getStratifiedSample(self.img1d, num_samples).astype(np.float64)
+
         inertias = []
         x_vals = np.arange(1, max_test)
-        for i in x_vals:
-            # run on sample to save time for approximation
-            image_arr_sample = shuffle(
-                self.img1d, random_state=0, n_samples=num_samples
+        KMeans = self._getKMeans()
+
+        if n_jobs > 1:
+
+            def fitInertia(k):
+                kmeans = KMeans(n_clusters=k, n_init="auto", random_state=random_state)
+                return kmeans.fit(sample).inertia_
+
+            with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+                for start in range(0, len(x_vals), n_jobs):
+                    inertias.extend(
+                        executor.map(fitInertia, x_vals[start : start + n_jobs])
+                    )
+                    if self._isKneePassed(inertias, tol, patience):
+                        break
+        else:
+            rng = np.random.default_rng(random_state)
+
+            # A single cluster is centered on the mean, every larger k is warm started from the centers of the k before it
+            kmeans = KMeans(
+                n_clusters=1, init=sample.mean(axis=0, keepdims=True), n_init=1
             )
-            kmeans = KMeans(n_clusters=i, n_init="auto", random_state=random_state)
-            kmeans.fit(image_arr_sample)
-            inertia = kmeans.inertia_
-            inertias.append(inertia)
+            kmeans.fit(sample)
+            inertias.append(kmeans.inertia_)
+
+            for i in x_vals[1:]:
+                # Add a center k-means++ style, with a probability proportional to the squared distance to the current centers
+                sqDistances = kmeans.transform(sample).min(axis=1) ** 2
+                if sqDistances.sum() == 0:
+                    # Every sampled pixel is already a center, more clusters cannot help
+                    break
+                newCenter = sample[
+                    rng.choice(len(sample), p=sqDistances / sqDistances.sum())
+                ]
+                centers = np.vstack([kmeans.cluster_centers_, newCenter])
 
-        # plt.plot(x_vals, inertias)
+                kmeans = KMeans(n_clusters=i, init=centers, n_init=1)
+                kmeans.fit(sample)
+                inertias.append(kmeans.inertia_)
+
+                if self._isKneePassed(inertias, tol, patience):
+                    break
+
+        # plt.plot(x_vals[: len(inertias)], inertias)
         # plt.show()
 
+        curve = inertias + [inertias[-1]] * (len(x_vals) - len(inertias))
+
         kn = KneeLocator(
             x=x_vals,
-            y=inertias,
+            y=curve,
             curve="convex",
             direction="decreasing",
         )
+
+        if return_inertias:
+            return kn.knee, x_vals[: len(inertias)], np.array(inertias)
+
         return kn.knee
 
+    def _isKneePassed(self, inertias: list, tol: float, patience: int) -> bool:
+        """
+        Returns whether each of the last patience k values lowered the inertia by less than tol of the single cluster inertia
+        """
+
+        if len(inertias) <= patience + 1:
+            return False
+
+        decreases = -np.diff(inertias[-patience - 1 :]) / inertias[0]
+        return bool(np.all(decreases < tol))
+
     def plt_cluster_pie(self):
         """
         Plots a pie chart based on the percentage of each color in the image
@@ -178,6 +717,144 @@ class PbnGen:
         self.image = img.copy()
         self.img1d = self.get1DImg(self.image)
 
+        # An arbitrary image has no known palette, the label map is re-derived from the image when needed
+        self.labelMap = None
+        self.colorPalette = None
+        # The palette index of the image border drawn by set_final_pbn, None without one
+        self.borderIndex = None
+
+    def setLabelMap(
+        self, labelMap: np.ndarray, colorPalette: np.ndarray, borderIndex: int = None
+    ):
+        """
+        Updates the canonical quantized state of the image to a label map and palette, and renders self.image from them.
+        Unused palette entries are dropped and the palette is sorted by RGB value so each color has one stable index.
+
+        Arguments:
+            labelMap: A (H, W) integer array where every value is an index into colorPalette
+            colorPalette: A (K, 3) array of RGB colors
+            borderIndex=None: The index of the image border in colorPalette. The border is never merged with a paint of
+                the same color and is moved to index 0, which is stored in self.borderIndex
+        """
+
+        labelMap, colorPalette = self._compactLabelMap(
+            labelMap, colorPalette, borderIndex
+        )
+        self.borderIndex = None if borderIndex is None else 0
+
+        self.image = colorPalette[labelMap]
+        self.img1d = self.get1DImg(self.image)
+
+        self.labelMap = labelMap
+        self.colorPalette = colorPalette
+
+    def getLabelMap(self, copy: bool = True) -> "tuple[np.ndarray, np.ndarray]":
+        """
+        Returns the label map and palette of the current image. If the image was not quantized through setLabelMap
+        they are derived from the unique colors of the image once and then stored.
+
+        Arguments:
+            copy=True: Whether to return copies that can be modified. Set to False to avoid the copies when only reading.
+
+        Returns:
+            (labelMap, colorPalette)
+            labelMap: A (H, W) uint8 (or wider if needed) array of indices into colorPalette
+            colorPalette: A (K, 3) uint8 array of the unique RGB colors in the image sorted by value
+        """
+
+        if self.labelMap is None:
+            colorPalette, labelMap = np.unique(self.img1d, axis=0, return_inverse=True)
+            self.colorPalette = colorPalette.astype(np.uint8)
+            self.labelMap = labelMap.reshape(self.image.shape[:2]).astype(
+                self._getLabelDtype(len(colorPalette))
+            )
+
+        if copy:
+            return self.labelMap.copy(), self.colorPalette.copy()
+
+        return self.labelMap, self.colorPalette
+
+    def _getLabelDtype(self, numColors: int) -> type:
+        """
+        Returns the smallest integer type that can index a palette of numColors colors
+        """
+
+        if numColors <= 256:
+            return np.uint8
+        elif numColors <= 65536:
+            return np.uint16
+
+        return np.int32
+
+    def _compactLabelMap(
+        self, labelMap: np.ndarray, colorPalette: np.ndarray, borderIndex: int = None
+    ) -> "tuple[np.ndarray, np.ndarray]":
+        """
+        Drops palette entries that no pixel uses, merges duplicate colors and sorts the palette by RGB value,
+        remapping the label map accordingly.
+
+        Arguments:
+            labelMap: A (H, W) integer array of indices into colorPalette
+            colorPalette: A (K, 3) array of RGB colors
+            borderIndex=None: An entry that is kept apart from the duplicate merge and put first
+
+        Returns:
+            (labelMap, colorPalette) with colorPalette as a (N, 3) uint8 array of unique colors, N <= K, apart from the
+            border entry
+        """
+
+        colorPalette = np.asarray(colorPalette).astype(np.uint8)
+
+        counts = np.bincount(labelMap.ravel(), minlength=len(colorPalette))
+        usedIndices = np.flatnonzero(counts)
+        if borderIndex is not None:
+            usedIndices = usedIndices[usedIndices != borderIndex]
+
+        uniqueColors, inverse = np.unique(
+            colorPalette[usedIndices], axis=0, return_inverse=True
+        )
+        newIndices = inverse.ravel()
+        if borderIndex is not None:
+            # A paint with the color of the border stays a separate, paintable entry
+            usedIndices = np.append(borderIndex, usedIndices)
+            newIndices = np.append(0, newIndices + 1)
+            uniqueColors = np.vstack([colorPalette[borderIndex], uniqueColors])
+
+        # Map the old indices to the new ones with a lookup array applied to every pixel in a single gather
+        newIndices = newIndices.astype(self._getLabelDtype(len(uniqueColors)))
+
+        return self._remapLabels(labelMap, usedIndices, newIndices), uniqueColors
+
+    def _remapLabels(
+        self, labels: np.ndarray, oldLabels: np.ndarray, newLabels: np.ndarray = None
+    ) -> np.ndarray:
+        """
+        Maps every value of labels found in oldLabels to the value at the same position in newLabels in a single gather
+        through a lookup array indexed by label, instead of comparing the whole array against every label
+
+        Arguments:
+            labels: An array of non negative integer labels of any shape
+            oldLabels: A (L,) array of the labels to map
+            newLabels=None: A (L,) array of the values to map them to, defaults to their positions 0 to L - 1
+
+        Returns:
+            remapped: An array shaped like labels with the dtype of newLabels, labels not in oldLabels map to 0
+        """
+
+        oldLabels = np.asarray(oldLabels)
+        newLabels = (
+            np.arange(len(oldLabels)) if newLabels is None else np.asarray(newLabels)
+        )
+
+        maxLabel = max(
+            int(labels.max()) if labels.size > 0 else 0,
+            int(oldLabels.max()) if oldLabels.size > 0 else 0,
+        )
+        lookup = np.zeros(maxLabel + 1, dtype=newLabels.dtype)
+        lookup[oldLabels] = newLabels
+
+        return lookup[labels]
+
     def getImage(self) -> np.ndarray:
         """
         Returns a copy of the current image that can be stored or modified
@@ -256,6 +933,18 @@ class PbnGen:
             dimension=None: A tuple representing the manual size the image should be in the form (H, W). Overrides any given scale value.
         """
 
+        if self.labelMap is not None:
+            # Resize the label map instead of the rendered image so no new blended colors appear at region edges
+            H, W = self.labelMap.shape
+            NH, NW = (
+                dimension if dimension is not None else (int(H * scale), int(W * scale))
+            )
+            labelMap = cv2.resize(
+                self.labelMap, (NW, NH), interpolation=cv2.INTER_NEAREST
+            )
+            self.setLabelMap(labelMap, self.colorPalette, self.borderIndex)
+            return
+
         resized = self.resizeImage(scale=scale, dimension=dimension)
 
         self.setImage(resized)
@@ -294,8 +983,7 @@ class PbnGen:
                 image, d=ksize, sigmaColor=sigmaColor, sigmaSpace=sigmaSpace
             )
 
-        self.image = blurred
-        self.img1d = self.get1DImg(self.image)
+        self.setImage(blurred)
 
     def getUniqueColors(self, image=None) -> np.ndarray:
         """
@@ -310,6 +998,9 @@ class PbnGen:
 
         reshaped_image = None
         if image is None:
+            if self.labelMap is not None:
+                return self.colorPalette.copy()
+
             # Reshape to a 2D array
             reshaped_image = self.image.reshape(-1, self.image.shape[2])
         else:
@@ -331,11 +1022,11 @@ class PbnGen:
 
         colorsDict = {}
 
-        uniqueColors = self.getUniqueColors()
+        labelMap, colorPalette = self.getLabelMap(copy=False)
 
-        for color in uniqueColors:
+        for index, color in enumerate(colorPalette):
             colorsDict[tuple(color)] = np.repeat(
-                np.all(self.image == color, axis=2)[..., np.newaxis], repeats=3, axis=2
+                (labelMap == index)[..., np.newaxis], repeats=3, axis=2
             )
 
         self.colorMasks = colorsDict
@@ -344,25 +1035,27 @@ class PbnGen:
 
     def generatePrunableClusters(self, showPlots=False):
         """
-        Stores color masks in self.prunableClusters which can be pruned from the main image. The small pruned clusters can be replaced by the nearest color
+        Stores label masks in self.prunableClusters which can be pruned from the main image. The small pruned clusters can be replaced by the nearest color
         in the original image in a different function. The treshold used to determine which clusters should be removed is defined as self.pruningThreshold
 
         Arguments:
             showPlots=False: Whether or not to show plots of pruned clusters
+
+        Returns:
+            numPrunable: The number of clusters below the threshold over all colors
         """
 
-        colorsDict = self.getUniqueColorsMasks()
+        labelMap, colorPalette = self.getLabelMap(copy=False)
 
         prunableClusters = {}
+        prunableClusterStats = {}
+        numPrunable = 0
 
-        for color in colorsDict.keys():
-            mask = colorsDict[color]
-
-            # Convert color tuple to an array
-            color = np.array(color, dtype=np.uint8)
-            singleColorImage = color * mask
+        for index, color in enumerate(colorPalette):
+            mask = (labelMap == index).astype(np.uint8)
 
             if showPlots:
+                singleColorImage = color * mask[..., np.newaxis]
                 plt.imshow(singleColorImage), plt.title(color)
                 plt.show()
 
@@ -373,7 +1066,7 @@ class PbnGen:
                 stats,
                 centroids,
             ) = cv2.connectedComponentsWithStatsWithAlgorithm(
-                (mask[..., 0] * 255).astype(np.uint8), 8, cv2.CV_32S, cv2.CCL_WU
+                mask * 255, 8, cv2.CV_32S, cv2.CCL_WU
             )
 
             if showPlots:
@@ -390,6 +1083,7 @@ class PbnGen:
             negatable = labelIndices[tooSmall]
             negateMask = np.isin(labels, negatable)
             labels[negateMask] *= -1
+            numPrunable += len(negatable)
 
             # Convert from labels to a mask where each pruned cluster has its unique segmented label
             labels[labels > 0] = 0
@@ -399,14 +1093,19 @@ class PbnGen:
                 plt.imshow(labels), plt.title("Pruned clusters")
                 plt.show()
 
-            prunableClusters[tuple(color)] = labels
+            prunableClusters[index] = labels
+            prunableClusterStats[index] = stats
 
             if showPlots:
                 binaryLabels = (labels > 0).astype(np.uint8)
-                plt.imshow(mask[..., 0] - binaryLabels), plt.title("After pruning")
+                plt.imshow(mask - binaryLabels), plt.title("After pruning")
                 plt.show()
 
         self.prunableClusters = prunableClusters
+        # The connected component stats of each color, indexed by the labels in its prunableClusters mask
+        self.prunableClusterStats = prunableClusterStats
+
+        return numPrunable
 
     def getClusteringEffectiveness(
         self,
@@ -468,13 +1167,14 @@ class PbnGen:
             Dictionaries with the number of clusters per color in the current image, and how many will be pruned
         """
 
-        colorsDict = self.getUniqueColorsMasks()
+        labelMap, colorPalette = self.getLabelMap(copy=False)
 
         rawCounts = {}
         prunedCounts = {}
 
-        for color in colorsDict.keys():
-            mask = colorsDict[color]
+        for index, color in enumerate(colorPalette):
+            color = tuple(color)
+            mask = (labelMap == index).astype(np.uint8)
 
             # The mask seems to need to be a "binary" image but the binary values are 0 and 255 instead of 0 and 1
             (
@@ -483,7 +1183,7 @@ class PbnGen:
                 stats,
                 centroids,
             ) = cv2.connectedComponentsWithStatsWithAlgorithm(
-                (mask[..., 0] * 255).astype(np.uint8), 8, cv2.CV_32S, cv2.CCL_WU
+                mask * 255, 8, cv2.CV_32S, cv2.CCL_WU
             )
 
             rawCounts[color] = numLabels
@@ -505,14 +1205,15 @@ class PbnGen:
         and will return the most common color surrounding the mask.
 
         Arguments:
-            image: The image to use as a reference for the surrounding colors
+            image: The image to use as a reference for the surrounding colors, either a (H, W, 3) image or a (H, W) label map
             mask: A binary mask which will be used to determine the cluster of pixels we want to find the common color around
 
         Returns:
-            mostCommonColor: A (3,) numpy array which holds the RGB value of the most common color
+            mostCommonColor: A (3,) numpy array which holds the RGB value of the most common color, or the most common label
+                when image is a label map
         """
 
-        assert image.shape[:-1] == mask.shape, "Image and mask shapes are different!"
+        assert image.shape[:2] == mask.shape, "Image and mask shapes are different!"
 
         edgeFilter = np.array(([0, 1, 0], [1, -4, 1], [0, 1, 0]))
 
@@ -522,71 +1223,208 @@ class PbnGen:
 
         surroundingColors = image[maskEdges.astype(bool)]
 
-        # most_common(1) returns a list with a single tuple (key, count)
-        mostCommonColor = Counter(map(tuple, surroundingColors)).most_common(1)[0][0]
-        return np.array(mostCommonColor, dtype=np.uint8)
+        mostCommonColor = self._getMostCommonValue(surroundingColors)
+        return np.array(mostCommonColor, dtype=image.dtype)
+
+    def _getMostCommonValue(self, values: np.ndarray):
+        """
+        Returns the most common value of an (N,) array of labels or the most common row of an (N, 3) array of colors.
+        Ties go to the value that appears first.
+        """
+
+        if values.ndim == 1:
+            counts = np.bincount(values)
+            # The first value whose count is the maximum
+            return values[np.argmax(counts[values] == counts.max())].item()
+
+        # Pack each RGB color into a single integer so colors can be counted without Python tuples
+        values = values.astype(np.int64)
+        packed = (values[:, 0] << 16) | (values[:, 1] << 8) | values[:, 2]
+        uniqueValues, firstIndices, counts = np.unique(
+            packed, return_index=True, return_counts=True
+        )
+        mostCommon = values[firstIndices[counts == counts.max()].min()]
+
+        return tuple(mostCommon.tolist())
 
     def getMainSurroundingColorVectorized(
-        self, image, mask, uniqueLabels
+        self, image, mask, uniqueLabels, stats=None
     ) -> np.ndarray:
         """
         Returns the main surrounding colors given a labeled mask and image. The function will check the edges of the mask to determine the present colors
         and will return the most common color surrounding the mask.
 
         Arguments:
-            image: The image to use as a reference for the surrounding colors
+            image: The image to use as a reference for the surrounding colors, either a (H, W, 3) image or a (H, W) label map
             mask: A 3D binary mask of shape (H, W, N) where N is the number of unique clusters excluding the background. The mask should be 1 where
                 a certain unique label exists and 0 elsewhere.
+            uniqueLabels: The labels in mask to find the surrounding colors of
+            stats=None: The connected component stats of mask indexed by label, only their bounding boxes are used so each
+                label is processed within its own bounding box. Computed from mask when None.
 
         Returns:
-            modeColors: A (N, 3) numpy array which holds the RGB values of the most common colors for each label
+            modeColors: A (N, 3) numpy array which holds the RGB values of the most common colors for each label, or an (N,) array
+                of the most common labels when image is a label map
         """
 
         # assert image.shape[:-1] == mask.shape, 'Image and mask shapes are different!'
 
-        edgeFilter = np.array(([0, 1, 0], [1, -4, 1], [0, 1, 0]), dtype=np.int32)
+        if stats is None:
+            stats = self._getLabelBoundingBoxes(mask)
 
         modeColors = []
         for label in uniqueLabels:
-            maskEdges = cv2.filter2D(
-                (mask == label).astype(np.uint8), ddepth=-1, kernel=edgeFilter
-            ).astype(bool)
+            window, labelMask, maskEdges = self._getLabelEdges(mask, label, stats)
             # plt.figure(figsize=(20, 20)), plt.imshow(maskEdges), plt.title('Small cluster edge'), plt.show()
-            modeColors.append(
-                Counter(map(tuple, image[maskEdges])).most_common(1)[0][0]
-            )
+            modeColors.append(self._getMostCommonValue(image[window][maskEdges]))
 
-        return np.array(modeColors, dtype=np.uint8)
+        return np.array(modeColors, dtype=image.dtype)
 
-    # TODO: If time allows, re-write this to merge similar intensities along strong gradients to preserve things like the whiskers in the Red Panda image
-    def pruneClustersSmart(
-        self,
-        iterations: int = 3,
-        pruneBySize=False,
-        reversePruneBySize=False,
-        reversePruneByIntensity=True,
-        showPlots=False,
-    ):
+    def _getLabelEdges(
+        self, mask: np.ndarray, label: int, stats: np.ndarray
+    ) -> "tuple[tuple, np.ndarray, np.ndarray]":
         """
-        Prunes small color clusters in order of cluster size and color intensity. The pruned clusters are based on the self.pruningThreshold class variable
-        and this function just determines the order that clusters are pruned to produce slightly different results.
+        Finds the pixels around a label within its bounding box grown by a pixel
 
         Arguments:
-            iterations: How many times clusters are pruned by repeating this same function.
-            pruneBySize=False: Whether prunable clusters should be pruned from smallest to largest. This has a large impact on performance if set to True.
-                When set to False, the smart method is pretty much as fast as the simple method
+            mask: A (H, W) label mask
+            label: The label to find the edge of
+            stats: The connected component stats or bounding boxes of mask indexed by label
+
+        Returns:
+            (window, labelMask, maskEdges)
+            window: A tuple of slices selecting the grown bounding box from any (H, W) array
+            labelMask: A binary mask of the label within the window
+            maskEdges: A boolean mask of every pixel in the window outside the label with one of its 4 neighbors inside the label
+        """
+
+        height, width = mask.shape[:2]
+        x, y, w, h = stats[label, :4]
+        window = (
+            slice(max(y - 1, 0), min(y + h + 1, height)),
+            slice(max(x - 1, 0), min(x + w + 1, width)),
+        )
+
+        labelMask = (mask[window] == label).astype(np.uint8)
+        maskEdges = (
+            cv2.dilate(labelMask, cv2.getStructuringElement(cv2.MORPH_CROSS, (3, 3)))
+            > labelMask
+        )
+
+        return window, labelMask, maskEdges
+
+    def _pruneClustersBySize(
+        self, labelMap: np.ndarray, colorIndices: list, reverse: bool = False
+    ):
+        """
+        Replaces the prunable clusters of the given colors in the label map one at a time with their main surrounding label,
+        in order of the cluster areas from the connected component stats, so each cluster is merged based on the clusters
+        pruned before it. Clusters of a single color never touch, so the order only matters across colors.
+        Every step only touches the cluster's bounding box.
+
+        Arguments:
+            labelMap: The (H, W) label map to edit in place
+            colorIndices: The palette indices in self.prunableClusters to prune the clusters of, the areas are sorted
+                stably so equally sized clusters keep this order
+            reverse=False: Prune from largest to smallest instead of smallest to largest
+        """
+
+        clusterColors, clusterLabels, clusterAreas = [], [], []
+        for colorIndex in colorIndices:
+            labels = np.unique(self.prunableClusters[colorIndex])[1:]
+            clusterColors.append(np.full(len(labels), colorIndex))
+            clusterLabels.append(labels)
+            clusterAreas.append(
+                self.prunableClusterStats[colorIndex][labels, cv2.CC_STAT_AREA]
+            )
+
+        if len(clusterColors) == 0:
+            return
+
+        clusterColors = np.concatenate(clusterColors)
+        clusterLabels = np.concatenate(clusterLabels)
+        order = np.argsort(np.concatenate(clusterAreas), kind="stable")
+        if reverse:
+            order = order[::-1]
+
+        for colorIndex, label in zip(
+            clusterColors[order].tolist(), clusterLabels[order].tolist()
+        ):
+            window, labelMask, maskEdges = self._getLabelEdges(
+                self.prunableClusters[colorIndex],
+                label,
+                self.prunableClusterStats[colorIndex],
+            )
+            labelMap[window][labelMask > 0] = self._getMostCommonValue(
+                labelMap[window][maskEdges]
+            )
+
+    def _getLabelBoundingBoxes(self, mask: np.ndarray) -> np.ndarray:
+        """
+        Gets the bounding box of every label in a (H, W) label mask in the layout of connected component stats
+
+        Returns:
+            boxes: A (L, 4) array of (x, y, width, height) indexed by label, labels that are not present have empty boxes
+        """
+
+        ys, xs = np.nonzero(mask)
+        labels = mask[ys, xs]
+        numLabels = int(labels.max()) + 1 if len(labels) > 0 else 1
+
+        x0 = np.full(numLabels, mask.shape[1])
+        y0 = np.full(numLabels, mask.shape[0])
+        x1 = np.zeros(numLabels, dtype=np.int64)
+        y1 = np.zeros(numLabels, dtype=np.int64)
+        np.minimum.at(x0, labels, xs)
+        np.minimum.at(y0, labels, ys)
+        np.maximum.at(x1, labels, xs + 1)
+        np.maximum.at(y1, labels, ys + 1)
+
+        return np.stack(
+            [x0, y0, np.maximum(x1 - x0, 0), np.maximum(y1 - y0, 0)], axis=1
+        )
+
+    # TODO: If time allows, re-write this to merge similar intensities along strong gradients to preserve things like the whiskers in the Red Panda image
+    def pruneClustersSmart(
+        self,
+        iterations: int = 3,
+        pruneBySize=False,
+        reversePruneBySize=False,
+        reversePruneByIntensity=True,
+        showPlots=False,
+    ):
+        """
+        Prunes small color clusters in order of cluster size and color intensity. The pruned clusters are based on the self.pruningThreshold class variable
+        and this function just determines the order that clusters are pruned to produce slightly different results.
+
+        Arguments:
+            iterations: The maximum number of times clusters are pruned by repeating this same function. Stops early once no cluster
+                is below the threshold or a pass changes nothing.
+            pruneBySize=False: Whether prunable clusters of all colors should be pruned one at a time from smallest to largest, each seeing
+                the ones pruned before it, with the intensity order breaking ties. The order comes from the connected component areas
+                and every cluster only touches its bounding box, so this is about as fast as pruning color by color
             reversePruneBySize=False: By default, prunes clusters from smallest to largest. Set to True to prune by largest to smallest.
             reversePruneByIntensity=True: Whether clusters should be pruned based on color intensity in order from darkest to lightest by default.
             showPlots=False: Whether to show intermediate pruning plots for each iteration.
+
+        Returns:
+            report: A record of every pass, see pruneClustersSimple
         """
 
+        report = []
         for i in range(iterations):
-            self.generatePrunableClusters(showPlots=False)
+            startTime = time.time()
+            numPrunable = self.generatePrunableClusters(showPlots=False)
+
+            # Nothing is below the threshold anymore
+            if numPrunable == 0:
+                report.append(self._getPruningRecord(i, 0, 0, startTime))
+                break
 
-            image = self.image.copy().astype(np.int32)
+            labelMap, colorPalette = self.getLabelMap()
             prunableClusters = self.prunableClusters
 
-            mergedColors = -np.ones_like(image, dtype=np.int32)
+            mergedColors = -np.ones_like(self.image, dtype=np.int32)
 
             if showPlots:
                 plt.figure(figsize=(20, 20)), plt.imshow(self.image), plt.title(
@@ -595,51 +1433,39 @@ class PbnGen:
 
             colorsOrdered = sorted(
                 prunableClusters.items(),
-                key=lambda x: np.sum(np.array(x[0])) ** 2,
+                key=lambda x: np.sum(colorPalette[x[0]], dtype=np.int64) ** 2,
                 reverse=reversePruneByIntensity,
             )
 
-            for color, labelMask in colorsOrdered:
-                color = np.array(color, dtype=np.uint8)
-
-                uniqueLabels = np.unique(labelMask)[1:]
-
-                # Get the labels in an order sorted by their patch size in the labelMask excluding the last element which is the background
-                if pruneBySize:
-                    uniqueLabels = np.array(
-                        sorted(
-                            uniqueLabels, key=lambda x: Counter(labelMask.flatten())[x]
-                        )[:-1]
-                    )
-                    if reversePruneBySize:
-                        uniqueLabels[::-1]
-
-                # plt.figure(figsize=(20, 20)), plt.imshow(labelMask), plt.title('labelMask'), plt.show()
-
-                # If no unique labels are detected, continue to the next color
-                if uniqueLabels.shape[0] == 0:
-                    continue
-
-                surroundingColors = self.getMainSurroundingColorVectorized(
-                    image, labelMask, uniqueLabels
+            if pruneBySize:
+                # Clusters of a single color never touch each other, so the size order is taken across all colors
+                self._pruneClustersBySize(
+                    labelMap,
+                    [colorIndex for colorIndex, labelMask in colorsOrdered],
+                    reverse=reversePruneBySize,
                 )
+            else:
+                for colorIndex, labelMask in colorsOrdered:
+                    uniqueLabels = np.unique(labelMask)[1:]
 
-                # Create an index mapping for each unique label
-                consistentIndexingMap = {
-                    label: index for index, label in enumerate(uniqueLabels)
-                }
+                    # plt.figure(figsize=(20, 20)), plt.imshow(labelMask), plt.title('labelMask'), plt.show()
 
-                # Create an indexed version of labelMask for non-zero labels
-                consistentLabelMask = np.zeros_like(labelMask)
+                    # If no unique labels are detected, continue to the next color
+                    if uniqueLabels.shape[0] == 0:
+                        continue
 
-                # Edit the current label mask so it has consistent integer values to quickly map them to colors
-                for label, index in consistentIndexingMap.items():
-                    consistentLabelMask[labelMask == label] = index
+                    surroundingLabels = self.getMainSurroundingColorVectorized(
+                        labelMap,
+                        labelMask,
+                        uniqueLabels,
+                        self.prunableClusterStats[colorIndex],
+                    )
 
-                # Apply the mapping only to non-zero labels
-                image[labelMask != 0] = surroundingColors[
-                    consistentLabelMask[labelMask != 0]
-                ]
+                    # Map every pruned label to its surrounding label in a single gather, only for non-zero labels
+                    prunedPixels = labelMask != 0
+                    labelMap[prunedPixels] = self._remapLabels(
+                        labelMask[prunedPixels], uniqueLabels, surroundingLabels
+                    )
 
             if showPlots:
                 plt.figure(figsize=(20, 20)), plt.imshow(mergedColors), plt.title(
@@ -655,24 +1481,46 @@ class PbnGen:
                     "Before pruning"
                 ), plt.show()
                 # plt.figure(figsize=(20, 20)), plt.imshow(prunedImage), plt.title('After pruning'), plt.show()
+                image = colorPalette[labelMap]
                 plt.figure(figsize=(20, 20)), plt.imshow(image), plt.title(
                     "After pruning"
                 ), plt.show()
 
                 plt.figure(figsize=(20, 20)), plt.imshow(
-                    np.abs(self.image - image)
+                    np.abs(self.image.astype(np.int32) - image)
                 ), plt.title("Diff"), plt.show()
 
-            self.setImage(image.copy())
+            pixelsChanged = int(np.count_nonzero(labelMap != self.labelMap))
+            self.setLabelMap(labelMap, colorPalette)
+            report.append(
+                self._getPruningRecord(i, numPrunable, pixelsChanged, startTime)
+            )
+
+            # A pass that changed nothing would repeat identically
+            if pixelsChanged == 0:
+                break
 
-    def pruneClustersSimple(self, iterations: int = 3, showPlots=False, trySlow=False):
+        self.pruningReport = report
+        return report
+
+    def pruneClustersSimple(
+        self, iterations: int = 3, showPlots=False, trySlow=False, incremental=True
+    ):
         """
         A simple cluster pruning method which iteratively prunes the smallest clusters below the self.pruningThreshold class variable.
         In most cases, this simple method produces similar results to pruneClustersSmart(), but is faster.
 
         Arguments:
-            iterations: How many times clusters are pruned by repeating this same function. A single iteration probably isn't
-                guaranteed to remove all small clusters, so this function can be run any number of times to ensure all clusters are pruned
+            iterations: The maximum number of times clusters are pruned by repeating this same function. A single iteration probably isn't
+                guaranteed to remove all small clusters, so passes are repeated until no cluster is below the threshold, a pass changes
+                nothing, or this many passes ran
+            incremental=True: Whether passes after the first only recompute the connected components in windows around the pixels
+                the previous pass changed, so they cost in proportion to what changed. The result is the same as recomputing
+                the whole image.
+
+        Returns:
+            report: A list with a dict for every pass holding its iteration number, the number of regions below the threshold that
+                were pruned, the number of pixels that changed color and the seconds it took
         """
 
         print(f"Starting pruning... \nIteration (of {iterations}): ", end="")
@@ -682,88 +1530,1250 @@ class PbnGen:
                 "WARNING: USING ITERATIVE self.getMainSurroundingColor()! EXPECT POOR PERFORMANCE"
             )
 
+        report = []
+        dirtyPixels = None
         for i in range(iterations):
             print(f"{i+1} ", end="")
+            startTime = time.time()
 
-            image = self.image.copy().astype(np.int32)
-            # print('Starting generatePrunableClusters()')
-            self.generatePrunableClusters(showPlots=False)
-            # print('Done!')
+            labelMap, colorPalette = self.getLabelMap()
+            if dirtyPixels is not None:
+                # Only regions that grew in the last pass can be below the threshold now, so the components are only
+                # recomputed in windows around the pixels that changed
+                numPrunable = self._pruneDirtyWindows(labelMap, dirtyPixels)
+            else:
+                # print('Starting generatePrunableClusters()')
+                numPrunable = self.generatePrunableClusters(showPlots=False)
+                # print('Done!')
+
+                prunableClusters = self.prunableClusters
+
+                if showPlots:
+                    plt.figure(figsize=(20, 20)), plt.imshow(self.image), plt.title(
+                        "Before pruning"
+                    ), plt.show()
+
+                # print('Starting pruning loop')
+                for colorIndex, labelMask in prunableClusters.items():
+                    uniqueLabels = np.unique(labelMask)[
+                        1:
+                    ]  # Exclude the first label which refers to the background
+
+                    # If no unique labels are detected, continue to the next color
+                    if uniqueLabels.shape[0] == 0:
+                        continue
+
+                    if trySlow:
+                        # A much slower iterative version of cluster pruning
+                        surroundingLabelsList = []
+                        for label in uniqueLabels:
+                            clusterMask = (labelMask != label).astype(np.uint8)
+                            surroundingLabel = self.getMainSurroundingColor(
+                                labelMap, clusterMask
+                            )
+                            surroundingLabelsList.append(surroundingLabel)
+
+                        surroundingLabels = np.array(
+                            surroundingLabelsList, dtype=labelMap.dtype
+                        )
 
-            prunableClusters = self.prunableClusters
+                        for idx in range(uniqueLabels.shape[0]):
+                            currentLabel = uniqueLabels[idx]
+                            labelMap[labelMask == currentLabel] = surroundingLabels[idx]
+
+                    else:
+                        # The fast vectorized version
+                        surroundingLabels = self.getMainSurroundingColorVectorized(
+                            labelMap,
+                            labelMask,
+                            uniqueLabels,
+                            self.prunableClusterStats[colorIndex],
+                        )
+
+                        # Map every pruned label to its surrounding label in a single gather, only for non-zero labels
+                        prunedPixels = labelMask != 0
+                        labelMap[prunedPixels] = self._remapLabels(
+                            labelMask[prunedPixels], uniqueLabels, surroundingLabels
+                        )
+
+            # Nothing is below the threshold anymore
+            if numPrunable == 0:
+                report.append(self._getPruningRecord(i, 0, 0, startTime))
+                break
 
             if showPlots:
                 plt.figure(figsize=(20, 20)), plt.imshow(self.image), plt.title(
                     "Before pruning"
                 ), plt.show()
+                image = colorPalette[labelMap]
+                plt.figure(figsize=(20, 20)), plt.imshow(image), plt.title(
+                    "After pruning"
+                ), plt.show()
 
-            # print('Starting pruning loop')
-            for color, labelMask in prunableClusters.items():
-                color = np.array(color, dtype=np.uint8)
+                plt.figure(figsize=(20, 20)), plt.imshow(
+                    np.abs(self.image.astype(np.int32) - image)
+                ), plt.title("Diff"), plt.show()
+
+            changedPixels = labelMap != self.labelMap
+            pixelsChanged = int(np.count_nonzero(changedPixels))
+            self.setLabelMap(labelMap, colorPalette)
+            report.append(
+                self._getPruningRecord(i, numPrunable, pixelsChanged, startTime)
+            )
 
-                uniqueLabels = np.unique(labelMask)[
-                    1:
-                ]  # Exclude the first label which refers to the background
+            # A pass that changed nothing would repeat identically
+            if pixelsChanged == 0:
+                break
 
-                # If no unique labels are detected, continue to the next color
-                if uniqueLabels.shape[0] == 0:
-                    continue
+            if incremental and not trySlow:
+                dirtyPixels = changedPixels
+
+        print(f"\nDone after {len(report)} iterations!")
+        for record in report:
+            print(
+                f"  {record['iteration']}: pruned {record['regionsPruned']} regions, "
+                f"{record['pixelsChanged']} pixels changed in {record['seconds']:.2f}s"
+            )
+
+        self.pruningReport = report
+        return report
+
+    def _pruneDirtyWindows(self, labelMap: np.ndarray, dirtyPixels: np.ndarray) -> int:
+        """
+        Runs a pruning pass like pruneClustersSimple that only recomputes connected components in windows around dirty pixels.
+        Clusters are only ever pruned whole, so a cluster that contains no pixel changed by the previous pass kept its area
+        and is still above the threshold, only the clusters of the dirty pixels have to be checked. Each color is checked in
+        windows around its own dirty pixels. A cluster that touches the edge of its window inside the image may continue
+        outside of it, so if it is not already larger than the threshold it is checked again in a window with a larger margin.
+        A cluster below the threshold spans fewer pixels than the threshold area, so it never touches the edge of a window with
+        that margin. The result matches a full pass.
+
+        Arguments:
+            labelMap: The (H, W) label map to prune in place
+            dirtyPixels: A (H, W) boolean mask of the pixels changed by the previous pass
+
+        Returns:
+            numPrunable: The number of clusters below the threshold that were pruned
+        """
+
+        height, width = labelMap.shape
+        minArea = self.getImageArea() * self.pruningThreshold
+        maxMargin = int(np.ceil(minArea)) + 1
+
+        dirtyYs, dirtyXs = np.nonzero(dirtyPixels)
+        dirtyLabels = labelMap[dirtyYs, dirtyXs]
+
+        # The components below the threshold of every color as (window, labels, stats, prunableLabels)
+        windowClusters = {}
+        numPrunable = 0
+
+        for index in np.unique(dirtyLabels):
+            ys, xs = dirtyYs[dirtyLabels == index], dirtyXs[dirtyLabels == index]
+            margin = 32
+
+            while len(ys) > 0:
+                unresolvedYs, unresolvedXs = [], []
+
+                for window in self._getDirtyWindows(ys, xs, labelMap.shape, margin):
+                    (y0, y1), (x0, x1) = [(s.start, s.stop) for s in window]
+
+                    # The mask seems to need to be a "binary" image but the binary values are 0 and 255 instead of 0 and 1
+                    (
+                        numLabels,
+                        labels,
+                        stats,
+                        centroids,
+                    ) = cv2.connectedComponentsWithStatsWithAlgorithm(
+                        (labelMap[window] == index).astype(np.uint8) * 255,
+                        8,
+                        cv2.CV_32S,
+                        cv2.CCL_WU,
+                    )
+
+                    inWindow = (ys >= y0) & (ys < y1) & (xs >= x0) & (xs < x1)
+                    seedYs, seedXs = ys[inWindow], xs[inWindow]
+                    seedLabels = labels[seedYs - y0, seedXs - x0]
+                    candidates = np.unique(seedLabels)
+
+                    x, y, w, h, areas = stats[candidates].T
+                    # Clusters cut by the window edge may continue outside of it, edges on the image border are real
+                    touchesEdge = (
+                        ((x == 0) & (x0 > 0))
+                        | ((y == 0) & (y0 > 0))
+                        | ((x + w == x1 - x0) & (x1 < width))
+                        | ((y + h == y1 - y0) & (y1 < height))
+                    )
+                    tooSmall = areas < minArea
+
+                    prunableLabels = candidates[tooSmall & ~touchesEdge]
+                    if len(prunableLabels) > 0:
+                        windowClusters.setdefault(index, []).append(
+                            (window, labels, stats, prunableLabels)
+                        )
+                        numPrunable += len(prunableLabels)
 
-                if trySlow:
-                    # A much slower iterative version of cluster pruning
-                    surroundingColorsList = []
-                    for label in uniqueLabels:
-                        clusterMask = (labelMask != label).astype(np.uint8)
-                        surroundingColor = self.getMainSurroundingColor(
-                            image, clusterMask
+                    # At the largest margin a cluster reaching the window edge is larger than the threshold
+                    if margin < maxMargin:
+                        unresolved = np.isin(
+                            seedLabels, candidates[tooSmall & touchesEdge]
                         )
-                        surroundingColorsList.append(surroundingColor)
+                        unresolvedYs.append(seedYs[unresolved])
+                        unresolvedXs.append(seedXs[unresolved])
+
+                if margin >= maxMargin:
+                    break
 
-                    surroundingColors = np.array(surroundingColorsList, dtype=np.uint8)
+                ys, xs = np.concatenate(unresolvedYs), np.concatenate(unresolvedXs)
+                margin = min(margin * 4, maxMargin)
 
-                    for idx in range(uniqueLabels.shape[0]):
-                        currentLabel = uniqueLabels[idx]
-                        currentColor = surroundingColors[idx, :]
-                        image[labelMask == currentLabel] = currentColor
+        # Prune color by color in palette order like a full pass
+        for index in sorted(windowClusters):
+            for window, labels, stats, prunableLabels in windowClusters[index]:
+                windowLabels = labelMap[window]
+                surroundingLabels = self.getMainSurroundingColorVectorized(
+                    windowLabels, labels, prunableLabels, stats
+                )
+
+                prunedPixels = self._remapLabels(
+                    labels, prunableLabels, np.ones(len(prunableLabels), dtype=bool)
+                )
+                windowLabels[prunedPixels] = self._remapLabels(
+                    labels[prunedPixels], prunableLabels, surroundingLabels
+                )
+
+        return numPrunable
+
+    def _getDirtyWindows(
+        self, ys: np.ndarray, xs: np.ndarray, shape: tuple, margin: int
+    ) -> list:
+        """
+        Covers the given pixels with non overlapping windows that reach at least margin pixels past every pixel.
+        The image is split into tiles of margin pixels, the tiles holding a pixel are grown by a tile and every group of
+        touching tiles gets a window around it, windows that overlap are merged.
 
+        Arguments:
+            ys: The (N,) row of every pixel
+            xs: The (N,) column of every pixel
+            shape: The (H, W) shape of the image
+            margin: How many pixels around every pixel a window covers
+
+        Returns:
+            windows: A list of (rows, columns) tuples of slices
+        """
+
+        height, width = shape[:2]
+        if len(ys) == 0:
+            return []
+
+        dirtyTiles = np.zeros((-(-height // margin), -(-width // margin)), np.uint8)
+        dirtyTiles[ys // margin, xs // margin] = 1
+
+        grownTiles = cv2.dilate(dirtyTiles, np.ones((3, 3), np.uint8))
+        numGroups, groups, stats, centroids = cv2.connectedComponentsWithStats(
+            grownTiles, connectivity=8
+        )
+
+        boxes = [
+            [x * margin, y * margin, (x + w) * margin, (y + h) * margin]
+            for x, y, w, h in stats[1:, :4].tolist()
+        ]
+
+        # Merge overlapping boxes until none overlap
+        merged = True
+        while merged:
+            merged = False
+            disjointBoxes = []
+            for box in boxes:
+                for other in disjointBoxes:
+                    if (
+                        box[0] < other[2]
+                        and other[0] < box[2]
+                        and box[1] < other[3]
+                        and other[1] < box[3]
+                    ):
+                        other[:] = [
+                            min(box[0], other[0]),
+                            min(box[1], other[1]),
+                            max(box[2], other[2]),
+                            max(box[3], other[3]),
+                        ]
+                        merged = True
+                        break
                 else:
-                    # The fast vectorized version
-                    surroundingColors = self.getMainSurroundingColorVectorized(
-                        image, labelMask, uniqueLabels
+                    disjointBoxes.append(box)
+            boxes = disjointBoxes
+
+        return [
+            (slice(y0, min(y1, height)), slice(x0, min(x1, width)))
+            for x0, y0, x1, y1 in boxes
+        ]
+
+    def _getPruningRecord(
+        self, iteration: int, regionsPruned: int, pixelsChanged: int, startTime: float
+    ) -> dict:
+        """
+        Returns the report entry of a pruning pass that started at startTime
+        """
+
+        return {
+            "iteration": iteration + 1,
+            "regionsPruned": regionsPruned,
+            "pixelsChanged": pixelsChanged,
+            "seconds": time.time() - startTime,
+        }
+
+    def pruneClustersGraph(self):
+        """
+        Prunes every region smaller than self.pruningThreshold in a single pass over a region adjacency graph. All regions
+        are labeled once, each edge of the graph holds the length of the border two regions share, and undersized regions
+        are merged from smallest to largest into the neighboring color they share the longest border with, using a priority
+        queue and union find. A merged region that is still too small is queued again, so unlike pruneClustersSimple
+        no fixed number of iterations is needed.
+        """
+
+        labelMap, colorPalette = self.getLabelMap(copy=False)
+        minArea = self.getImageArea() * self.pruningThreshold
+        self.setLabelMap(self._mergeSmallRegions(labelMap, minArea), colorPalette)
+
+    def _mergeSmallRegions(self, labelMap: np.ndarray, minArea: float) -> np.ndarray:
+        """
+        Merges every region smaller than minArea into the neighboring color it shares the longest border with, see
+        pruneClustersGraph
+
+        Arguments:
+            labelMap: A (H, W) label map
+            minArea: The smallest area in pixels a region may have, regions without neighbors are kept whatever their area
+
+        Returns:
+            labelMap: A new (H, W) label map of the same dtype
+        """
+
+        regionMap, regionColors, regionStats = self._getRegionMap(labelMap)
+        numRegions = len(regionColors)
+
+        # A dict of {neighbor region: shared border length} for every region
+        adjacency = [{} for _ in range(numRegions)]
+        pairs, lengths = self._getRegionAdjacency(regionMap, numRegions)
+        for (a, b), length in zip(pairs.tolist(), lengths.tolist()):
+            adjacency[a][b] = length
+            adjacency[b][a] = length
+
+        colors = regionColors.tolist()
+        areas = regionStats[:, cv2.CC_STAT_AREA].tolist()
+        parent = list(range(numRegions))
+
+        queue = [(area, region) for region, area in enumerate(areas) if area < minArea]
+        heapq.heapify(queue)
+
+        while queue:
+            area, region = heapq.heappop(queue)
+
+            # Skip entries of regions that were merged away or grew since they were queued
+            if parent[region] != region or areas[region] != area:
+                continue
+
+            neighbors = adjacency[region]
+            if not neighbors:
+                continue
+
+            votes = {}
+            for neighbor, length in neighbors.items():
+                votes[colors[neighbor]] = votes.get(colors[neighbor], 0) + length
+            color = max(votes, key=votes.get)
+
+            # Recoloring the region connects it to every neighbor of that color, so they all become one region
+            merged = [region] + [n for n in neighbors if colors[n] == color]
+            mergedSet = set(merged)
+            # Keep the region with the most neighbors as the root so the fewest adjacency entries are moved
+            root = max(merged, key=lambda r: len(adjacency[r]))
+            rootNeighbors = adjacency[root]
+
+            for other in merged:
+                if other == root:
+                    continue
+
+                parent[other] = root
+                areas[root] += areas[other]
+
+                for neighbor, length in adjacency[other].items():
+                    if neighbor in mergedSet:
+                        continue
+                    neighborAdjacency = adjacency[neighbor]
+                    del neighborAdjacency[other]
+                    neighborAdjacency[root] = neighborAdjacency.get(root, 0) + length
+                    rootNeighbors[neighbor] = rootNeighbors.get(neighbor, 0) + length
+
+                adjacency[other] = None
+
+            for other in merged:
+                rootNeighbors.pop(other, None)
+
+            colors[root] = color
+            if areas[root] < minArea:
+                heapq.heappush(queue, (areas[root], root))
+
+        # Resolve every region to its root and recolor the label map in a single gather
+        roots = np.array(parent)
+        while True:
+            nextRoots = roots[roots]
+            if np.array_equal(nextRoots, roots):
+                break
+            roots = nextRoots
+
+        regionLabels = np.array(colors, dtype=labelMap.dtype)[roots]
+        return regionLabels[regionMap]
+
+    def _getRegionMap(
+        self, labelMap: np.ndarray
+    ) -> "tuple[np.ndarray, np.ndarray, np.ndarray]":
+        """
+        Labels every 8-connected region of a single palette index in the label map with its own id
+
+        Arguments:
+            labelMap: A (H, W) label map
+
+        Returns:
+            (regionMap, regionColors, regionStats)
+            regionMap: A (H, W) int32 array with the region id of every pixel, ids run from 0 to R - 1
+            regionColors: A (R,) array with the palette index of every region
+            regionStats: A (R, 5) array with the connected component stats of every region, their bounding boxes and areas
+        """
+
+        regionMap = np.empty(labelMap.shape, dtype=np.int32)
+        regionColors = []
+        regionStats = []
+        numRegions = 0
+
+        # Every palette index that is present, without sorting every pixel like np.unique
+        for index in np.flatnonzero(np.bincount(labelMap.ravel())):
+            mask = labelMap == index
+
+            # The mask seems to need to be a "binary" image but the binary values are 0 and 255 instead of 0 and 1
+            (
+                numLabels,
+                labels,
+                stats,
+                centroids,
+            ) = cv2.connectedComponentsWithStatsWithAlgorithm(
+                mask.view(np.uint8) * np.uint8(255), 8, cv2.CV_32S, cv2.CCL_GRANA
+            )
+
+            # Component 0 is the background, shift the others to follow the regions of the previous colors
+            np.add(labels, numRegions - 1, out=regionMap, where=mask)
+            regionColors.append(np.full(numLabels - 1, index))
+            regionStats.append(stats[1:])
+            numRegions += numLabels - 1
+
+        return regionMap, np.concatenate(regionColors), np.concatenate(regionStats)
+
+    def _getRegionAdjacency(
+        self, regionMap: np.ndarray, numRegions: int
+    ) -> "tuple[np.ndarray, np.ndarray]":
+        """
+        Finds every pair of 4-adjacent regions and the length of the border they share by comparing each pixel with its
+        right and bottom neighbor
+
+        Arguments:
+            regionMap: A (H, W) array of region ids from _getRegionMap
+            numRegions: The number of regions in regionMap
+
+        Returns:
+            (pairs, lengths)
+            pairs: An (E, 2) array of region ids with the smaller id first
+            lengths: An (E,) array with the number of pixel edges on the border of each pair
+        """
+
+        horizontal = regionMap[:, :-1] != regionMap[:, 1:]
+        vertical = regionMap[:-1, :] != regionMap[1:, :]
+
+        first = np.concatenate(
+            [regionMap[:, :-1][horizontal], regionMap[:-1, :][vertical]]
+        ).astype(np.int64)
+        second = np.concatenate(
+            [regionMap[:, 1:][horizontal], regionMap[1:, :][vertical]]
+        ).astype(np.int64)
+
+        keys = np.minimum(first, second) * numRegions + np.maximum(first, second)
+        keys, lengths = np.unique(keys, return_counts=True)
+
+        return np.stack([keys // numRegions, keys % numRegions], axis=1), lengths
+
+    def _traceRegions(
+        self, labelMap: np.ndarray, minArea: float = 0, holes: bool = False
+    ) -> "tuple[list, np.ndarray, np.ndarray]":
+        """
+        Traces the outline of every region of the label map. The regions are labeled once and every region is traced within
+        its own bounding box, so the cost grows with the number of regions rather than colors times pixels. Each outline is
+        the outer contour of the region grown by its 4-connected edge, so neighboring shapes overlap instead of leaving gaps.
+
+        Arguments:
+            labelMap: A (H, W) label map
+            minArea=0: Regions whose grown bounding box is smaller than this area cannot make a shape this large and are skipped
+            holes=False: Also traces the holes of every region where other regions are nested inside it
+
+        Returns:
+            (regionContours, regionMap, regionStats)
+            regionContours: A list with a list of (regionId, contour) tuples for every palette index, each contour is an
+                OpenCV (N, 1, 2) array of points. With holes the contour is replaced by a list of the outer contour
+                followed by the contours of its holes.
+            regionMap: A (H, W) int32 array with the region id of every pixel
+            regionStats: A (R, 5) array with the connected component stats of every region
+        """
+
+        height, width = labelMap.shape
+        regionMap, regionColors, regionStats = self._getRegionMap(labelMap)
+        crossKernel = cv2.getStructuringElement(cv2.MORPH_CROSS, (3, 3))
+
+        numColors = int(labelMap.max()) + 1 if labelMap.size > 0 else 0
+        regionContours = [[] for _ in range(numColors)]
+
+        for region, (x, y, w, h, area) in enumerate(regionStats.tolist()):
+            if (w + 2) * (h + 2) < minArea:
+                continue
+
+            # Grow the bounding box by a pixel to fit the edge around the region
+            x0, y0 = max(x - 1, 0), max(y - 1, 0)
+            x1, y1 = min(x + w + 1, width), min(y + h + 1, height)
+            regionMask = (regionMap[y0:y1, x0:x1] == region).astype(np.uint8)
+
+            contours, hierarchy = cv2.findContours(
+                cv2.dilate(regionMask, crossKernel),
+                cv2.RETR_CCOMP if holes else cv2.RETR_EXTERNAL,
+                cv2.CHAIN_APPROX_TC89_L1,
+                offset=(x0, y0),
+            )
+            for k, contour in enumerate(contours):
+                if not holes:
+                    regionContours[regionColors[region]].append((region, contour))
+                elif hierarchy[0, k, 3] == -1:
+                    # The outer contours are the top level of the two level hierarchy and their holes are their children
+                    children = np.flatnonzero(hierarchy[0, :, 3] == k)
+                    rings = [contour]
+                    rings.extend(contours[j] for j in children if len(contours[j]) >= 3)
+                    regionContours[regionColors[region]].append((region, rings))
+
+        return regionContours, regionMap, regionStats
+
+    def _buildTopology(
+        self, labelMap: np.ndarray
+    ) -> "tuple[list, list, np.ndarray, np.ndarray]":
+        """
+        Builds a planar topology of the label map. Region borders follow the pixel edges and are split into arcs wherever three
+        or more regions meet. Every arc is kept once and referenced by the regions on both of its sides, so neighboring
+        shapes share the exact same border instead of each tracing their own copy.
+
+        The border of every region is followed on all pixel edges at once: each pixel edge with a different region across
+        knows the next edge of its ring from the 2x2 pixels at its end, the rings are then found and ordered by pointer jumping.
+
+        Arguments:
+            labelMap: A (H, W) label map
+
+        Returns:
+            (arcs, regionRings, regionMap, regionColors, regionStats)
+            arcs: A list of (N, 2) int arrays of x, y pixel corner coordinates, closed arcs repeat their first point at the end
+            regionRings: A list with the rings of every region, each ring is a list of arc references where ~k is arc k
+                reversed. Regions are on the right of their rings, so outer rings run clockwise on screen and holes
+                counterclockwise.
+            regionMap: A (H, W) int32 array with the region id of every pixel
+            regionColors: A (R,) array with the palette index of every region
+            regionStats: A (R, 5) array with the connected component stats of every region
+        """
+
+        height, width = labelMap.shape
+        regionMap, regionColors, regionStats = self._getRegionMap(labelMap)
+        padded = np.pad(regionMap, 1, constant_values=-1)
+
+        # The directions of travel along the top, right, bottom and left edge of a pixel with the pixel on the right.
+        # The pixel across an edge is one step to the left of its direction of travel.
+        steps = ((0, 1), (1, 0), (0, -1), (-1, 0))
+        corners = ((0, 0), (1, 0), (1, 1), (0, 1))
+
+        edges = {
+            "id": [],
+            "next": [],
+            "side": [],
+            "x": [],
+            "y": [],
+            "region": [],
+            "across": [],
+            "crack": [],
+        }
+        for side in range(4):
+            di, dj = steps[side]
+            li, lj = steps[(side + 3) % 4]
+            across = padded[1 + li : 1 + li + height, 1 + lj : 1 + lj + width]
+            ys, xs = np.nonzero(across != regionMap)
+            region = regionMap[ys, xs]
+
+            # Turn left onto the diagonal pixel first so 8-connected regions stay one ring, else go straight, else turn right
+            turnLeft = padded[ys + di + li + 1, xs + dj + lj + 1] == region
+            straight = ~turnLeft & (padded[ys + di + 1, xs + dj + 1] == region)
+            nextSide = np.where(
+                turnLeft, (side + 3) % 4, np.where(straight, side, (side + 1) % 4)
+            )
+            nextY = np.where(turnLeft, ys + di + li, np.where(straight, ys + di, ys))
+            nextX = np.where(turnLeft, xs + dj + lj, np.where(straight, xs + dj, xs))
+
+            # Horizontal pixel edges are numbered before the vertical ones
+            if side % 2 == 0:
+                crack = (ys + side // 2) * width + xs
+            else:
+                crack = (height + 1) * width + ys * (width + 1) + xs + (side == 1)
+
+            edges["id"].append((side * height + ys) * width + xs)
+            edges["next"].append((nextSide * height + nextY) * width + nextX)
+            edges["side"].append(np.full(len(ys), side, dtype=np.int8))
+            edges["x"].append(xs + corners[side][0])
+            edges["y"].append(ys + corners[side][1])
+            edges["region"].append(region)
+            edges["across"].append(padded[ys + li + 1, xs + lj + 1])
+            edges["crack"].append(crack)
+
+        edges = {key: np.concatenate(value) for key, value in edges.items()}
+        numEdges = len(edges["id"])
+        indices = np.arange(numEdges)
+        # The ids are sorted because the edges are listed by side then in raster order
+        nextEdge = np.searchsorted(edges["id"], edges["next"])
+
+        # Label every ring with its smallest edge index, after k rounds every edge has the minimum of the 2^k edges after it
+        rings = indices.copy()
+        pointer = nextEdge
+        while True:
+            newRings = np.minimum(rings, rings[pointer])
+            pointer = pointer[pointer]
+            if np.array_equal(newRings, rings):
+                break
+            rings = newRings
+
+        # Rank every edge by its distance from the start of its ring
+        isStart = rings == indices
+        previousEdge = np.empty(numEdges, dtype=np.int64)
+        previousEdge[nextEdge] = indices
+        rank = (~isStart).astype(np.int64)
+        pointer = np.where(isStart, indices, previousEdge)
+        while not isStart[pointer].all():
+            rank = rank + rank[pointer]
+            pointer = pointer[pointer]
+
+        # Arcs end at every pixel corner where three or more regions meet
+        vertices = padded[:-1, :-1], padded[:-1, 1:], padded[1:, 1:], padded[1:, :-1]
+        degree = sum(
+            (vertices[k] != vertices[(k + 1) % 4]).astype(np.uint8) for k in range(4)
+        )
+        isJunction = (degree >= 3)[edges["y"], edges["x"]]
+
+        # Rotate the rings that have junctions to start at their first one so no arc wraps around the start
+        ringLengths = np.bincount(rings, minlength=numEdges)[rings]
+        offsets = np.zeros(numEdges, dtype=np.int64)
+        junctions = np.flatnonzero(isJunction)
+        firstJunction = np.full(numEdges, numEdges, dtype=np.int64)
+        np.minimum.at(firstJunction, rings[junctions], rank[junctions])
+        hasJunction = firstJunction < numEdges
+        offsets[hasJunction] = firstJunction[hasJunction]
+        rank = (rank - offsets[rings]) % ringLengths
+
+        order = np.lexsort((rank, rings))
+        edges = {key: value[order] for key, value in edges.items()}
+        rings = rings[order]
+        isJunction = isJunction[order]
+
+        ringStart = np.r_[True, rings[1:] != rings[:-1]]
+        pieceStart = ringStart | isJunction
+        pieceStarts = np.flatnonzero(pieceStart)
+        pieceEnds = np.r_[pieceStarts[1:], numEdges] - 1
+
+        # Both sides of a border cover the same pixel edges, the region with the smaller id or no region across owns the arc
+        keys = np.minimum.reduceat(edges["crack"], pieceStarts)
+        across = edges["across"][pieceStarts]
+        isOwner = (across == -1) | (edges["region"][pieceStarts] < across)
+        owners = np.flatnonzero(isOwner)
+        ownerOrder = np.argsort(keys[owners])
+        arcIds = np.empty(len(pieceStarts), dtype=np.int64)
+        arcIds[owners] = np.arange(len(owners))
+        twins = np.flatnonzero(~isOwner)
+        arcIds[twins] = ~ownerOrder[
+            np.searchsorted(keys[owners][ownerOrder], keys[twins])
+        ]
+
+        # Only the corners where the border turns and the ends of the arcs are kept
+        keepVertex = pieceStart | np.r_[True, edges["side"][1:] != edges["side"][:-1]]
+        points = np.stack([edges["x"], edges["y"]], axis=1)
+        lastSides = (edges["side"][pieceEnds] + 1) % 4
+        endPoints = points[pieceEnds] - np.array(corners)[edges["side"][pieceEnds]]
+        endPoints += np.array(corners)[lastSides]
+        keptIndices = np.flatnonzero(keepVertex)
+        pieceSplits = np.searchsorted(keptIndices, pieceStarts)
+        piecePoints = np.split(points[keptIndices], pieceSplits[1:])
+
+        arcs = [np.vstack([piecePoints[piece], endPoints[piece]]) for piece in owners]
+
+        regionRings = [[] for _ in range(len(regionStats))]
+        ringSplits = np.searchsorted(pieceStarts, np.flatnonzero(ringStart))
+        for start, end in zip(ringSplits, np.r_[ringSplits[1:], len(pieceStarts)]):
+            region = edges["region"][pieceStarts[start]]
+            regionRings[region].append(arcIds[start:end].tolist())
+
+        return arcs, regionRings, regionMap, regionColors, regionStats
+
+    def _simplifyPolyline(
+        self,
+        points: np.ndarray,
+        tolerance: float = 1.0,
+        method: str = "douglas-peucker",
+        closed: bool = False,
+    ) -> np.ndarray:
+        """
+        Straightens the pixel steps of a polyline. Open polylines keep their ends where they are so the arcs of a ring still meet.
+
+        Arguments:
+            points: An (N, 2) array of points
+            tolerance=1.0: For "douglas-peucker" the furthest the simplified polyline may be from any of its points.
+                For "visvalingam" points are removed while the triangle they make with their neighbors is smaller than
+                tolerance^2.
+            method="douglas-peucker": "douglas-peucker" or "visvalingam"
+            closed=False: Whether the last point connects back to the first
+
+        Returns:
+            points: The simplified (M, 2) array of points. Outlines that would collapse are returned as they are.
+        """
+
+        endsMeet = (
+            not closed and len(points) > 1 and np.array_equal(points[0], points[-1])
+        )
+        minPoints = 3 if closed else 4 if endsMeet else 2
+        if len(points) <= minPoints or tolerance <= 0:
+            return points
+
+        if endsMeet:
+            # A polyline that ends where it starts has no chord to measure against, so each half is simplified on its own
+            middle = len(points) // 2
+            simplified = np.concatenate(
+                [
+                    self._simplifyPolyline(points[: middle + 1], tolerance, method),
+                    self._simplifyPolyline(points[middle:], tolerance, method)[1:],
+                ]
+            )
+        elif method == "douglas-peucker":
+            curve = points.reshape(-1, 1, 2).astype(np.int32)
+            simplified = cv2.approxPolyDP(curve, tolerance, closed).reshape(-1, 2)
+        else:
+            simplified = self._simplifyVisvalingam(points, tolerance**2, closed)
+
+        if len(simplified) < minPoints:
+            return points
+        return simplified
+
+    def _simplifyVisvalingam(
+        self, points: np.ndarray, minArea: float, closed: bool = False
+    ) -> np.ndarray:
+        """
+        Visvalingam-Whyatt simplification, repeatedly removes the point that makes the smallest triangle with its neighbors
+
+        Arguments:
+            points: An (N, 2) array of points
+            minArea: Points are removed while the smallest triangle is smaller than this area
+            closed=False: Whether the last point connects back to the first, otherwise the ends are kept
+
+        Returns:
+            points: The simplified (M, 2) array of points
+        """
+
+        numPoints = len(points)
+        coords = points.astype(np.float64)
+        previousPoint = np.arange(numPoints) - 1
+        nextPoint = np.arange(numPoints) + 1
+        if closed:
+            previousPoint[0] = numPoints - 1
+            nextPoint[-1] = 0
+        removable = np.ones(numPoints, dtype=bool)
+        if not closed:
+            removable[[0, -1]] = False
+
+        def getArea(index):
+            a, b = coords[previousPoint[index]], coords[nextPoint[index]]
+            p = coords[index]
+            return (
+                abs((a[0] - p[0]) * (b[1] - p[1]) - (b[0] - p[0]) * (a[1] - p[1])) / 2
+            )
+
+        areas = np.full(numPoints, np.inf)
+        heap = []
+        for index in np.flatnonzero(removable).tolist():
+            areas[index] = getArea(index)
+            heap.append((areas[index], index))
+        heapq.heapify(heap)
+
+        removed = np.zeros(numPoints, dtype=bool)
+        numLeft = numPoints
+        while heap and numLeft > 3:
+            area, index = heapq.heappop(heap)
+            if removed[index] or area != areas[index]:
+                # A stale entry from before a neighbor was removed
+                continue
+            if area >= minArea:
+                break
+
+            removed[index] = True
+            numLeft -= 1
+            before, after = previousPoint[index], nextPoint[index]
+            nextPoint[before] = after
+            previousPoint[after] = before
+
+            # A neighbor never gets a smaller area than the point just removed so the order of removal stays consistent
+            for neighbor in (before, after):
+                if removable[neighbor]:
+                    areas[neighbor] = max(getArea(neighbor), area)
+                    heapq.heappush(heap, (areas[neighbor], neighbor))
+
+        return points[~removed]
+
+    def _simplifyOutlines(
+        self,
+        outlines: list,
+        tolerance: float,
+        method: str = "douglas-peucker",
+        closed: bool = False,
+    ) -> list:
+        """
+        Simplifies every outline and stores how many points were removed in self.geometryReport
+
+        Arguments:
+            outlines: A list of (N, 2) arrays of points
+            tolerance: See _simplifyPolyline
+            method="douglas-peucker": "douglas-peucker" or "visvalingam"
+            closed=False: Whether the outlines are closed rings
+
+        Returns:
+            outlines: A list of the simplified (M, 2) arrays of points
+        """
+
+        simplified = [
+            self._simplifyPolyline(outline, tolerance, method, closed)
+            for outline in outlines
+        ]
+        self.geometryReport = {
+            "method": method,
+            "tolerance": tolerance,
+            "pointsBefore": sum(map(len, outlines)),
+            "pointsAfter": sum(map(len, simplified)),
+        }
+        print(
+            f"Simplified outlines from {self.geometryReport['pointsBefore']} to {self.geometryReport['pointsAfter']} points"
+        )
+
+        return simplified
+
+    def _getCurveSegments(
+        self, points: np.ndarray, closed: bool = False, tolerance: float = 1.0
+    ) -> np.ndarray:
+        """
+        Fits cubic Bezier segments to a polyline by least squares (Schneider's algorithm). The polyline is cut at its
+        corners, every run of points between two corners is fitted with one curve that is split at its worst point
+        until it is within tolerance of the run. A run keeps its lines unless the curves take fewer points, so the
+        curves never make the path longer than the polyline.
+
+        Arguments:
+            points: An (N, 2) array of points, simplified so the pixel steps are gone, see _simplifyOutlines
+            closed=False: Whether the curve connects back to the first point
+            tolerance=1.0: How far in pixels the curves may stray from the polyline
+
+        Returns:
+            segments: An (S, 4, 2) array with the start, two control points and end of every segment, lines have their
+                control points on their ends, see _getLineSegmentMask
+        """
+
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        # Repeated points have no direction
+        keep = np.any(points != np.roll(points, -1, axis=0), axis=1)
+        keep[-1] |= not closed or not keep.any()
+        points = points[keep]
+        # Lines are segments with their control points on their ends
+        getLines = lambda run: np.stack([run[:-1], run[:-1], run[1:], run[1:]], axis=1)
+        if len(points) < (3 if closed else 2):
+            return getLines(np.vstack([points, points[:1]]) if closed else points)
+
+        n = len(points)
+        incoming = points - np.roll(points, 1, axis=0)
+        outgoing = np.roll(points, -1, axis=0) - points
+        for directions in (incoming, outgoing):
+            lengths = np.linalg.norm(directions, axis=1, keepdims=True)
+            directions /= np.where(lengths > 0, lengths, 1)
+        # The polyline turns by more than 60 degrees at a corner
+        corners = np.einsum("ij,ij->i", incoming, outgoing) < 0.5
+        if not closed:
+            corners[[0, -1]] = True
+        breaks = np.flatnonzero(corners)
+        if len(breaks) == 0:
+            # A ring without corners is cut in two where it runs on smoothly
+            breaks = np.array([0, n // 2])
+        # The tangents leaving and entering every break, a corner keeps the directions of its own lines
+        smooth = incoming + outgoing
+        smooth /= np.maximum(np.linalg.norm(smooth, axis=1, keepdims=True), 1e-12)
+        leaving = np.where(corners[:, None], outgoing, smooth)
+        entering = np.where(corners[:, None], -incoming, -smooth)
+
+        ends = np.append(breaks[1:], breaks[0] + n) if closed else breaks[1:]
+        segments = []
+        for start, end in zip(breaks, ends):
+            run = points[np.arange(start, end + 1) % n]
+            # A curve has three points, so it takes fewer than the lines only when it replaces four or more
+            maxSegments = (len(run) - 2) // 3
+            if maxSegments == 0:
+                segments.append(getLines(run))
+                continue
+            # The lines of the run are sampled every pixel so the curve follows them and not only their ends
+            lengths = np.linalg.norm(np.diff(run, axis=0), axis=1)
+            steps = np.maximum(np.ceil(lengths), 1).astype(int)
+            data = np.concatenate(
+                [
+                    a + (b - a) * (np.arange(k)[:, None] / k)
+                    for a, b, k in zip(run[:-1], run[1:], steps)
+                ]
+                + [run[-1:]]
+            )
+            fitted = self._fitCubic(
+                data, leaving[start], entering[end % n], tolerance, maxSegments
+            )
+            segments.append(getLines(run) if fitted is None else np.array(fitted))
+
+        return np.concatenate(segments)
+
+    def _fitCubic(
+        self,
+        data: np.ndarray,
+        tangentStart: np.ndarray,
+        tangentEnd: np.ndarray,
+        tolerance: float,
+        maxSegments: int = None,
+    ) -> list:
+        """
+        Fits cubic Bezier segments to a run of points, splitting the run at the point furthest from the curve until
+        every point is within tolerance
+
+        Arguments:
+            data: An (N, 2) array of the points of the run
+            tangentStart: The unit tangent leaving the first point
+            tangentEnd: The unit tangent entering the last point, pointing back along the run
+            tolerance: The largest distance in pixels of a point from the curve
+            maxSegments=None: Gives up once the run needs more segments than this
+
+        Returns:
+            segments: A list of (4, 2) arrays with the start, two control points and end of every segment, or None if
+                it would take more than maxSegments
+        """
+
+        segments = []
+        # The right half of a split is pushed first so the segments come out in order
+        stack = [(0, len(data) - 1, tangentStart, tangentEnd)]
+        while stack:
+            first, last, tangentStart, tangentEnd = stack.pop()
+            points = data[first : last + 1]
+            if len(points) == 2:
+                third = np.linalg.norm(points[1] - points[0]) / 3
+                segments.append(
+                    np.stack(
+                        [
+                            points[0],
+                            points[0] + tangentStart * third,
+                            points[1] + tangentEnd * third,
+                            points[1],
+                        ]
+                    )
+                )
+                continue
+
+            # Chord length parameters, refined by Newton's method while the curve is close
+            chords = np.linalg.norm(np.diff(points, axis=0), axis=1)
+            u = np.concatenate([[0], np.cumsum(chords)]) / max(chords.sum(), 1e-12)
+            segment = self._getLeastSquaresBezier(points, u, tangentStart, tangentEnd)
+            for iteration in range(5):
+                distances = np.linalg.norm(
+                    self._getBezierPoints(segment, u) - points, axis=1
+                )
+                split = np.argmax(distances[1:-1]) + 1
+                if distances[split] <= tolerance or distances[split] > 4 * tolerance:
+                    break
+                if iteration < 4:
+                    u = self._reparameterizeBezier(segment, points, u)
+                    segment = self._getLeastSquaresBezier(
+                        points, u, tangentStart, tangentEnd
                     )
 
-                    # Create an index mapping for each unique label
-                    consistentIndexingMap = {
-                        label: index for index, label in enumerate(uniqueLabels)
-                    }
+            if distances[split] <= tolerance:
+                segments.append(segment)
+                continue
 
-                    # Create an indexed version of labelMask for non-zero labels
-                    consistentLabelMask = np.zeros_like(labelMask)
+            if maxSegments is not None and len(segments) + len(stack) + 2 > maxSegments:
+                return None
+            center = points[split - 1] - points[split + 1]
+            center /= max(np.linalg.norm(center), 1e-12)
+            stack.append((first + split, last, -center, tangentEnd))
+            stack.append((first, first + split, tangentStart, center))
 
-                    # Edit the current label mask so it has consistent integer values to quickly map them to colors
-                    for label, index in consistentIndexingMap.items():
-                        consistentLabelMask[labelMask == label] = index
+        return segments
 
-                    # Apply the mapping only to non-zero labels
-                    image[labelMask != 0] = surroundingColors[
-                        consistentLabelMask[labelMask != 0]
-                    ]
+    def _getLeastSquaresBezier(
+        self,
+        points: np.ndarray,
+        u: np.ndarray,
+        tangentStart: np.ndarray,
+        tangentEnd: np.ndarray,
+    ) -> np.ndarray:
+        """
+        Gets the cubic Bezier segment through the ends of the points with its control points along the tangents at
+        the distances that best fit the points at their parameters
 
-            if showPlots:
-                plt.figure(figsize=(20, 20)), plt.imshow(self.image), plt.title(
-                    "Before pruning"
-                ), plt.show()
-                plt.figure(figsize=(20, 20)), plt.imshow(image), plt.title(
-                    "After pruning"
-                ), plt.show()
+        Arguments:
+            points: An (N, 2) array of points
+            u: The (N,) parameters of the points on the curve
+            tangentStart: The unit tangent leaving the first point
+            tangentEnd: The unit tangent entering the last point, pointing back along the points
 
-                plt.figure(figsize=(20, 20)), plt.imshow(
-                    np.abs(self.image - image)
-                ), plt.title("Diff"), plt.show()
+        Returns:
+            segment: A (4, 2) array with the start, two control points and end of the segment
+        """
+
+        first, last = points[0], points[-1]
+        b0, b1, b2, b3 = [basis[:, None] for basis in self._getBernstein(u)]
+        a1 = b1 * tangentStart
+        a2 = b2 * tangentEnd
+        rest = points - (b0 + b1) * first - (b2 + b3) * last
+        c11, c12, c22 = np.sum(a1 * a1), np.sum(a1 * a2), np.sum(a2 * a2)
+        x1, x2 = np.sum(a1 * rest), np.sum(a2 * rest)
+        determinant = c11 * c22 - c12 * c12
+        chord = np.linalg.norm(last - first)
+        alpha1 = alpha2 = chord / 3
+        if abs(determinant) > 1e-12:
+            alpha1 = (x1 * c22 - x2 * c12) / determinant
+            alpha2 = (c11 * x2 - c12 * x1) / determinant
+        if min(alpha1, alpha2) < 1e-6 * chord:
+            # Control points behind the ends would loop, the tangents are kept at a third of the chord instead
+            alpha1 = alpha2 = chord / 3
+
+        return np.stack(
+            [first, first + tangentStart * alpha1, last + tangentEnd * alpha2, last]
+        )
+
+    def _getBernstein(self, u: np.ndarray) -> tuple:
+        """
+        Gets the four cubic Bernstein polynomials at the parameters u
+        """
+
+        v = 1 - u
+        return v**3, 3 * u * v**2, 3 * u**2 * v, u**3
+
+    def _getBezierPoints(self, segment: np.ndarray, u: np.ndarray) -> np.ndarray:
+        """
+        Gets the (N, 2) points of a (4, 2) cubic Bezier segment at the parameters u
+        """
+
+        return sum(
+            basis[:, None] * p for basis, p in zip(self._getBernstein(u), segment)
+        )
+
+    def _reparameterizeBezier(
+        self, segment: np.ndarray, points: np.ndarray, u: np.ndarray
+    ) -> np.ndarray:
+        """
+        Moves the parameters of the points one Newton step towards the closest points of the curve
+
+        Arguments:
+            segment: A (4, 2) cubic Bezier segment
+            points: An (N, 2) array of points
+            u: The (N,) parameters of the points
+
+        Returns:
+            u: The (N,) improved parameters
+        """
+
+        first = 3 * np.diff(segment, axis=0)
+        second = 2 * np.diff(first, axis=0)
+        v = 1 - u
+        difference = self._getBezierPoints(segment, u) - points
+        derivative = (
+            (v**2)[:, None] * first[0]
+            + (2 * u * v)[:, None] * first[1]
+            + (u**2)[:, None] * first[2]
+        )
+        curvature = v[:, None] * second[0] + u[:, None] * second[1]
+        numerator = np.sum(difference * derivative, axis=1)
+        denominator = np.sum(derivative * derivative + difference * curvature, axis=1)
+        step = np.divide(
+            numerator, denominator, out=np.zeros_like(u), where=denominator != 0
+        )
+
+        return np.clip(u - step, 0, 1)
+
+    def _getLineSegmentMask(self, segments: np.ndarray) -> np.ndarray:
+        """
+        Finds the (S, 4, 2) curve segments that are lines, those with their control points on their ends
+
+        Returns:
+            mask: An (S,) boolean array, true for the lines
+        """
+
+        return np.all(segments[:, 1] == segments[:, 0], axis=1) & np.all(
+            segments[:, 2] == segments[:, 3], axis=1
+        )
+
+    def _getRingPoints(self, ring: list, arcs: list) -> np.ndarray:
+        """
+        Joins the arcs of a ring from _buildTopology into its points
+
+        Arguments:
+            ring: A list of arc references where ~k is arc k reversed
+            arcs: The list of arcs from _buildTopology
+
+        Returns:
+            points: An (N, 2) array of the ring points without repeating the first point
+        """
+
+        # Every arc ends where the next one starts
+        return np.concatenate(
+            [arcs[ref][:-1] if ref >= 0 else arcs[~ref][:0:-1] for ref in ring]
+        )
 
-            self.setImage(image)
+    def _getRingSegments(self, ring: list, arcSegments: list) -> np.ndarray:
+        """
+        Joins the curve segments of the arcs of a ring from _buildTopology
+
+        Arguments:
+            ring: A list of arc references where ~k is arc k reversed
+            arcSegments: A list with the (S, 4, 2) curve segments of every arc
+
+        Returns:
+            segments: An (S, 4, 2) array of the curve segments of the ring
+        """
 
-        print("\nDone!")
+        # A reversed segment runs through its points backwards
+        return np.concatenate(
+            [
+                arcSegments[ref] if ref >= 0 else arcSegments[~ref][::-1, ::-1]
+                for ref in ring
+            ]
+        )
+
+    def _getPathData(
+        self, polylines: list, closed: bool = True, relative: bool = False
+    ) -> str:
+        """
+        Writes polylines as the data of a single svg path
+
+        Arguments:
+            polylines: A list of (N, 2) arrays of points or (S, 4, 2) arrays of curve segments from _getCurveSegments
+            closed=True: Whether to close every polyline back to its first point
+            relative=False: Writes every point as the step from the previous one, see _getRelativePathData
+
+        Returns:
+            pathData: The d attribute of the path
+        """
+
+        if relative:
+            return "".join(
+                self._getRelativePathData(polyline, closed) for polyline in polylines
+            )
+
+        end = "Z" if closed else ""
+        pathData = []
+        for polyline in polylines:
+            if polyline.ndim == 3:
+                # Curve control points are rounded to a tenth of a pixel, lines only need their end
+                segments = np.round(polyline, 1)
+                lines = self._getLineSegmentMask(segments)
+                if closed and len(lines) > 1 and lines[-1]:
+                    # The last line back to the start is drawn by Z
+                    segments, lines = segments[:-1], lines[:-1]
+                commands = []
+                for segment, line in zip(segments.tolist(), lines.tolist()):
+                    command = "L" if line else "C"
+                    points = " ".join(
+                        "%g,%g" % (x, y) for x, y in segment[3 if line else 1 :]
+                    )
+                    if commands and commands[-1][0] == command:
+                        commands[-1][1].append(points)
+                    else:
+                        commands.append((command, [points]))
+                pathData.append(
+                    "M%g,%g" % tuple(segments[0, 0])
+                    + "".join(
+                        command + " ".join(points) for command, points in commands
+                    )
+                    + end
+                )
+            else:
+                pathData.append(
+                    "M" + " ".join(f"{x},{y}" for x, y in polyline.tolist()) + end
+                )
+
+        return "".join(pathData)
+
+    def _getRelativePathData(self, polyline: np.ndarray, closed: bool = True) -> str:
+        """
+        Writes a polyline as relative path commands, only the first point is absolute. The steps between traced points
+        are a few pixels so they take far fewer characters than the coordinates, numbers are only separated where the
+        minus sign does not already separate them.
+
+        Arguments:
+            polyline: An (N, 2) array of whole pixel points or an (S, 4, 2) array of curve segments from
+                _getCurveSegments, whose control points are rounded to a tenth of a pixel
+            closed=True: Whether to close the polyline back to its first point
+
+        Returns:
+            pathData: The path data of the polyline
+        """
+
+        if polyline.ndim == 3:
+            # Steps are taken between the tenths so rounding errors do not add up along the curve
+            tenths = np.round(polyline * 10).astype(np.int64)
+            lines = self._getLineSegmentMask(tenths)
+            if closed and len(lines) > 1 and lines[-1]:
+                # The last line back to the start is drawn by z
+                tenths, lines = tenths[:-1], lines[:-1]
+            start = (tenths[0, 0] / 10).tolist()
+            steps = (tenths[:, 1:] - tenths[:, :1]) / 10
+            # Lines only need the step to their end
+            commands = []
+            for segmentSteps, line in zip(steps.tolist(), lines.tolist()):
+                command = "l" if line else "c"
+                values = [v for step in segmentSteps[2 if line else 0 :] for v in step]
+                if commands and commands[-1][0] == command:
+                    commands[-1][1].extend(values)
+                else:
+                    commands.append((command, values))
+            formatNumber = lambda v: "%g" % v
+        else:
+            points = np.asarray(polyline).reshape(-1, 2).astype(np.int64)
+            start = points[0].tolist()
+            steps = np.diff(points, axis=0).reshape(-1).tolist()
+            commands = [("l", steps)] if steps else []
+            formatNumber = str
+
+        joinNumbers = lambda values: " ".join(map(formatNumber, values)).replace(
+            " -", "-"
+        )
+        pathData = "M" + joinNumbers(start)
+        for command, values in commands:
+            pathData += command + joinNumbers(values)
+
+        return pathData + ("z" if closed else "")
+
+    def _getCompactStyle(self, topology: bool = False) -> str:
+        """
+        Gets the style block of a compact svg, see output_to_svg. The class names are prefixed since an svg placed
+        inline shares its styles with the whole page.
+
+        Arguments:
+            topology: Whether the borders are stroked by an arc group instead of by every shape
+
+        Returns:
+            css: The content of the style element
+        """
+
+        labels = ".pbn-l{fill:#fff;stroke:#000;text-anchor:middle;pointer-events:none}"
+        if topology:
+            return ".pbn-a{fill:none;stroke:#000;pointer-events:none}" + labels
+
+        return ".pbn-c{stroke:#000}" + labels
 
     def getBoundaryImage(
         self, image: np.ndarray = None, scale: float = 1
@@ -793,140 +2803,660 @@ class PbnGen:
             img = self.resizeImage(image=img, scale=scale)
 
         boundaryImage = cv2.filter2D(img, ddepth=-1, kernel=edgeFilter)
-        boundaryImage = np.sum(boundaryImage, axis=2)
+        # Single channel masks are already a boundary per pixel
+        if boundaryImage.ndim == 3:
+            boundaryImage = np.sum(boundaryImage, axis=2)
         boundaryImage[boundaryImage > 0] = 1
 
         return boundaryImage
 
-    def set_final_pbn(self):
+    def set_final_pbn(self, prune_method="simple"):
         """
         Runs all necessary functions to get the final paint by number image
         and set the internal image representation to it.
+
+        Arguments:
+            prune_method="simple": "simple" prunes with 6 iterations of pruneClustersSimple, "graph" uses pruneClustersGraph
+                which gives visually matching results in a fraction of the time on busy images
         """
         originalDims = self.getImage().shape[:-1]
         self.blurImage_(blurType="bilateral", ksize=21, sigmaColor=21, sigmaSpace=14)
         self.resizeImage_(0.5)
         self.cluster_colors_()
-        self.pruneClustersSimple(iterations=6)
+        if prune_method == "graph":
+            self.pruneClustersGraph()
+        else:
+            self.pruneClustersSimple(iterations=6)
         self.resizeImage_(dimension=originalDims)
-        # draw rectangle around image so border is recognized
-        img = self.getImage()
-        img = cv2.rectangle(img, (0, 0), (img.shape[1], img.shape[0]), (0, 0, 0), 10)
-        self.setImage(img)
+        # draw rectangle around image so border is recognized, the black border gets its own palette entry
+        labelMap, colorPalette = self.getLabelMap()
+        borderMask = cv2.rectangle(
+            np.zeros(labelMap.shape, dtype=np.uint8),
+            (0, 0),
+            (labelMap.shape[1], labelMap.shape[0]),
+            1,
+            10,
+        )
+        colorPalette = np.vstack([colorPalette, [0, 0, 0]])
+        labelMap = labelMap.astype(self._getLabelDtype(len(colorPalette)))
+        labelMap[borderMask > 0] = len(colorPalette) - 1
+        self.setLabelMap(labelMap, colorPalette, borderIndex=len(colorPalette) - 1)
+
+    @classmethod
+    def final_pbn_batch(
+        cls, images: list, share_palette: bool = False, **kwargs
+    ) -> list:
+        """
+        Generates the final paint by numbers of a batch of similar images, e.g. photos from the same shoot, reusing the
+        palette of the first image instead of clustering every image from scratch
+
+        Arguments:
+            images: The images to pass to the constructor one at a time
+            share_palette: If True every image uses exactly the palette of the first image, otherwise every image is warm
+                started from the palette of the previous image and only refit when it drifted
+            kwargs: Any other constructor arguments
+
+        Returns:
+            pbns: A list with a PbnGen for each image on which set_final_pbn has been run
+        """
+
+        pbns = []
+        palette = None
+        for image in images:
+            if palette is None:
+                pbn = cls(image, **kwargs)
+            elif share_palette:
+                pbn = cls(image, paint_set=palette.astype(np.uint8), **kwargs)
+            else:
+                pbn = cls(image, init_palette=palette, **kwargs)
+
+            pbn.set_final_pbn()
+            if palette is None or not share_palette:
+                palette = pbn.palette * 255
+            pbns.append(pbn)
+
+        return pbns
 
-    def output_to_svg(self, svg_path: str, output_palette_path: str = None):
+    def output_to_svg(
+        self,
+        svg_path: str,
+        output_palette_path: str = None,
+        topology: bool = False,
+        output_topology_path: str = None,
+        simplify_tolerance: float = None,
+        simplify_method: str = "douglas-peucker",
+        curves: bool = False,
+        holes: bool = False,
+        compact: bool = False,
+        palette_format: str = "list",
+        shape_metadata: bool = False,
+        embed_palette: bool = False,
+        check_coverage: bool = False,
+    ):
         """
         Gets a boundary image between colors in a PBN template by running an edge filter on the provided image or self.image.
         Upscaling the image before passing it to this function gives better resolution.
 
         Arguments:
-            svg_path: File path to output the svg to.
+            svg_path: File path to output the svg to, or an open binary stream to write it to.
+            output_palette_path: File path to output the palette json to.
+            topology: Writes every border between two regions once as a shared arc in a single stroked path and fills the
+                shapes from the same arcs without a stroke, instead of outlining every shape on its own. Neighboring
+                shapes meet exactly and no border is stroked twice, but this is not a way to shrink the svg: fills cannot
+                reference the arcs, so every fill repeats its rings and the svg is about three times larger than the
+                traced one.
+            simplify_tolerance: How far in pixels the simplified outlines may stray from the traced ones, the quality knob
+                that trades fidelity for fewer points. None keeps the traced points, or straightens the pixel steps of the
+                arcs with a tolerance of 1 with topology.
+            simplify_method: "douglas-peucker" or "visvalingam", see _simplifyPolyline
+            curves: Fits cubic Bezier curves to the simplified outlines by least squares and writes them as paths
+                instead of polygons, one curve stands in for many points. The outlines are simplified with a tolerance
+                of 1 pixel when simplify_tolerance is not set, the curves stay within the same tolerance.
+            holes: Traces the holes of every shape and writes shapes with holes as a single path with fill-rule evenodd,
+                so the shapes nested inside are not painted over and clicks inside them reach them. Topology shapes
+                always have their holes.
+            compact: Writes a smaller svg that is faster to recolor. The shapes of each color are paths in one group
+                named in the "group" of the palette entry, so a color is switched by setting the fill of one element,
+                the path data is relative with whole pixels, and the stroke and labels are styled once in a style block.
+            palette_format: "list" for a list of entries with the id of every shape, or "ranges" for the ranges of ids of
+                every color, see palette_json.encode_palette
+            shape_metadata: Adds the area and label position of every shape to a "ranges" palette
+            embed_palette: Writes the palette json into a metadata element at the end of the svg, so the svg is a single
+                artifact that needs no separate palette file, see palette_json.extract_palette
+            check_coverage: A debugging aid that fills the written shapes into a mask again and stores the fraction of
+                the image no shape paints in self.uncoveredFraction
+            output_topology_path: File path to output the arcs and the arc references of every shape to as json.
+                Only used with topology. This is where every arc is stored once.
         Returns:
             palette: A dictionary of all colors in the image each with an array
             of unique html ids representing each shape. This will allow for javascript
-            manipulation of the color of each shape.
+            manipulation of the color of each shape. Encoded with encode_palette when
+            palette_format is "ranges".
         """
+        assert simplify_method in (
+            "douglas-peucker",
+            "visvalingam",
+        ), f"Unknown simplify_method {simplify_method}!"
+        assert palette_format in (
+            "list",
+            "ranges",
+        ), f"Unknown palette_format {palette_format}!"
+        self.geometryReport = None
+        self.uncoveredFraction = None
+
         h, w = self.getImage().shape[:2]
-        dwg = svgwrite.Drawing(svg_path, profile="tiny", viewBox=(f"0 0 {w} {h}"))
-        i = 0
-        palette = []
-        color_masks = self.getUniqueColorsMasks()
+        # Shapes are written to the file as they are made instead of building the whole document first, a stream that
+        # was passed in is left open
+        with (
+            open(svg_path, "wb") if isinstance(svg_path, str) else nullcontext(svg_path)
+        ) as outfile:
+            writer = SvgWriter(outfile, w, h, profile="full" if compact else "tiny")
+            i = 0
+            palette = []
+            # The area and label position of every shape by id for the shape metadata
+            shapeAreas = []
+            shapeLabels = []
+            # The rings of every written fill for the coverage check
+            paintedShapes = []
+            labelMap, colorPalette = self.getLabelMap(copy=False)
+            if compact:
+                writer.element(
+                    "style", self._getCompactStyle(topology), type="text/css"
+                )
+                labels = []
+            # The pixel steps are straightened before curves are fitted, within the same tolerance
+            tolerance = 1.0 if simplify_tolerance is None else simplify_tolerance
+            if topology:
+                (
+                    arcs,
+                    regionRings,
+                    regionMap,
+                    regionColors,
+                    regionStats,
+                ) = self._buildTopology(labelMap)
+                # The pixel steps of the arcs are always straightened, both sides of a border use the same simplified arc
+                arcs = self._simplifyOutlines(arcs, tolerance, simplify_method)
+                if curves:
+                    arcSegments = [
+                        self._getCurveSegments(arc, tolerance=tolerance) for arc in arcs
+                    ]
+                regionContours = [[] for _ in colorPalette]
+                for region, rings in enumerate(regionRings):
+                    regionContours[regionColors[region]].append((region, rings))
+                topologyRegions = []
+            else:
+                # Trace all region outlines from the label map at once
+                regionContours, regionMap, regionStats = self._traceRegions(
+                    labelMap, holes=holes
+                )
 
-        for idx, (color, mask) in enumerate(color_masks.items()):
-            mask[mask == False] = 0
-            mask[mask == True] = 1
-            boundary_img = self.getBoundaryImage(mask)
+                if simplify_tolerance is not None or curves:
+                    # The holes are simplified like the outer contours
+                    outlines = [
+                        ring.reshape(-1, 2)
+                        for contours in regionContours
+                        for _, c in contours
+                        for ring in (c if holes else [c])
+                    ]
+                    simplified = iter(
+                        self._simplifyOutlines(
+                            outlines, tolerance, simplify_method, closed=True
+                        )
+                    )
+                    getNext = lambda: next(simplified).reshape(-1, 1, 2)
+                    regionContours = [
+                        [
+                            (region, [getNext() for _ in c] if holes else getNext())
+                            for region, c in contours
+                        ]
+                        for contours in regionContours
+                    ]
 
-            # plt.imshow(boundary_img, cmap="gray")
-            # plt.show()
+            for idx, color in enumerate(colorPalette):
+                data = {}
+                color_str = str(tuple(color.tolist()))
+                data["color"] = color_str
+                data["shapes"] = []
+                if idx == self.borderIndex:
+                    # The frame around the image is not painted, the canvas leaves it out of the palette
+                    data["border"] = True
+                if compact:
+                    # Every shape of a color is in one group, so switching the color touches one element
+                    data["group"] = f"c{idx}"
+                    writer.begin_group(class_="pbn-c", fill="white", id=data["group"])
+                for region, c in regionContours[idx]:
+                    fill = "white"
+                    # fill = "rgb" + str(color)
+                    if not compact:
+                        writer.begin_group(fill=fill, stroke="black", id=str(i))
+
+                    if topology:
+                        rings = [
+                            self._getRingPoints(ring, arcs).astype(np.int32)
+                            for ring in c
+                        ]
+                        if check_coverage:
+                            paintedShapes.append(rings)
+                        if curves:
+                            rings = [
+                                self._getRingSegments(ring, arcSegments) for ring in c
+                            ]
+                        pathData = self._getPathData(rings, relative=compact)
+                        if compact:
+                            writer.path(pathData, id=str(i))
+                        else:
+                            # The borders are stroked once by the arcs
+                            writer.path(pathData, stroke="none")
+                        topologyRegions.append(
+                            {"id": str(i), "color": idx, "rings": regionRings[region]}
+                        )
+                    else:
+                        holeContours = []
+                        if holes:
+                            c, *holeContours = c
+                        if check_coverage:
+                            paintedShapes.append([c, *holeContours])
+                        # Compact shapes carry the id themselves instead of a group
+                        attributes = {"id": str(i)} if compact else {}
+                        self._writeShape(
+                            writer,
+                            c,
+                            holeContours,
+                            curves,
+                            compact,
+                            tolerance=tolerance,
+                            **attributes,
+                        )
 
-            contours, hierarchy = cv2.findContours(
-                boundary_img.astype(np.uint8),
-                cv2.RETR_EXTERNAL,
-                cv2.CHAIN_APPROX_TC89_L1,
-            )
+                    # add text label
+                    position = self.get_text_position(
+                        regionMap, region, regionStats[region]
+                    )
+                    offset = 0.5 if topology else 0
+                    shapeAreas.append(int(regionStats[region][cv2.CC_STAT_AREA]))
+                    shapeLabels.append([position[0] + offset, position[1] + offset])
+                    if compact:
+                        # The labels are written on top of all shapes once they are done
+                        labels.append((position, str(idx), offset))
+                    else:
+                        self.add_text_label(writer, position, str(idx), offset=offset)
+                        writer.end_group()
+
+                    data["shapes"].append(str(i))
+                    i += 1
+
+                if compact:
+                    writer.end_group()
+                palette.append(data)
+
+            if topology:
+                # Drawn last so every border is visible, without catching the clicks meant for the shapes
+                if compact:
+                    writer.begin_group(class_="pbn-a")
+                else:
+                    writer.begin_group(
+                        fill="none", stroke="black", pointer_events="none"
+                    )
+                for arc in arcSegments if curves else arcs:
+                    writer.path(
+                        self._getPathData([arc], closed=False, relative=compact)
+                    )
+                writer.end_group()
+                print(f"{len(arcs)} shared arcs")
+
+            if compact:
+                writer.begin_group(class_="pbn-l")
+                for position, label, offset in labels:
+                    self.add_text_label(writer, position, label, offset, compact=True)
+                writer.end_group()
+
+            if palette_format == "ranges":
+                if shape_metadata:
+                    palette = encode_palette(palette, shapeAreas, shapeLabels)
+                else:
+                    palette = encode_palette(palette)
 
-            data = {}
-            color_str = str(color)
-            data["color"] = color_str
-            data["shapes"] = []
-            for c in contours:
-                points = c.squeeze().tolist()
-                if len(c.squeeze().shape) == 1:
-                    points = [points]
+            if embed_palette:
+                # The palette travels inside the svg so one file describes the whole template
+                writer.element("metadata", json.dumps(palette), id=PALETTE_METADATA_ID)
+            writer.close()
+        print(f"{i} shapes")
+        if check_coverage:
+            # Every pixel should be painted by some shape, anything left over shows as an unpainted gap in the template
+            self.uncoveredFraction = self._getUncoveredFraction(paintedShapes, (h, w))
 
-                fill = "white"
-                # fill = "rgb" + str(color)
-                group = dwg.g(fill=fill, stroke="black", id=str(i))
-                shape = dwg.polygon(points)
+        if output_palette_path:
+            with open(output_palette_path, "w") as outfile:
+                json.dump(palette, outfile)
 
-                # add text label
-                text = self.add_text_label(dwg, c, str(idx))
+        if topology and output_topology_path:
+            with open(output_topology_path, "w") as outfile:
+                json.dump(
+                    {
+                        "width": w,
+                        "height": h,
+                        "arcs": [arc.tolist() for arc in arcs],
+                        "shapes": topologyRegions,
+                    },
+                    outfile,
+                )
 
-                group.add(shape)
-                group.add(text)
-                dwg.add(group)
+        return palette
 
-                data["shapes"].append(str(i))
-                i += 1
+    def output_to_tiles(
+        self,
+        output_dir: str,
+        levels: int = 3,
+        simplify_tolerance: float = None,
+        simplify_method: str = "douglas-peucker",
+    ) -> dict:
+        """
+        Writes the template as a pyramid of svg tiles with an index.json, see _writeTiles
 
-            palette.append(data)
+        Arguments:
+            output_dir: The directory to write index.json to, the tiles of level z are written to z/{column}_{row}.svg
+            levels=3: The number of levels
+            simplify_tolerance=None: How far in pixels the outlines of the last level may stray from the traced ones
+            simplify_method="douglas-peucker": "douglas-peucker" or "visvalingam", see _simplifyPolyline
 
-        dwg.save()
-        print(f"{i} shapes")
+        Returns:
+            index: The contents of index.json, see _writeTiles
+        """
 
-        if output_palette_path:
-            with open(output_palette_path, "w") as outfile:
-                json.dump(palette, outfile)
+        def openTile(fileName):
+            path = os.path.join(output_dir, fileName)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            return open(path, "wb")
 
-        return palette
+        index = self._writeTiles(openTile, levels, simplify_tolerance, simplify_method)
+        with open(os.path.join(output_dir, "index.json"), "w") as outfile:
+            json.dump(index, outfile)
 
-    def point_inside_contour(self, point, contour):
-        """Check if a point is inside a contour."""
-        return cv2.pointPolygonTest(contour, (point[0], point[1]), False) >= 0
-
-    def sample_text_position(self, contour, num_samples=150):
-        if len(contour) < 4:
-            # Not enough points to form a polygon return the centroid or the first point of the contour
-            moments = cv2.moments(contour)
-            if moments["m00"] != 0:
-                return (
-                    int(moments["m10"] / moments["m00"]),
-                    int(moments["m01"] / moments["m00"]),
-                )
+        return index
+
+    def _writeTiles(
+        self,
+        openTile,
+        levels: int = 3,
+        simplify_tolerance: float = None,
+        simplify_method: str = "douglas-peucker",
+    ) -> dict:
+        """
+        Writes the template as a pyramid of svg tiles for very large images, so a viewer can show a coarse level right away
+        and only load full detail where it zooms in. Level z splits the image into 2^z by 2^z tiles. The last level has the
+        outlines and labels of the full template, every level above it is simplified twice as much as the one below, leaves
+        out the shapes and holes smaller than a pixel at its scale and has no labels.
+
+        Regions too small to paint are merged into their neighbors first and every shape is written with its holes cut out
+        with fill-rule evenodd, so no shape covers the shapes nested in it and the tiles look the same in any order.
+        Every shape is written to the tile of a level that holds the center of its bounding box, so it is drawn whole and
+        only once per level, and keeps its id on every level. The index lists the bounds of what each tile draws, which is
+        also the view box of the tile, so a viewer can tell which tiles reach into the view.
+
+        Arguments:
+            openTile: A function that takes the name of a tile, z/{column}_{row}.svg for the tiles of level z, and returns
+                a binary stream to write it to as a context manager
+            levels=3: The number of levels
+            simplify_tolerance=None: How far in pixels the outlines of the last level may stray from the traced ones, see
+                output_to_svg. Coarser levels multiply it, or a tolerance of 1 when it is None, by their scale.
+            simplify_method="douglas-peucker": "douglas-peucker" or "visvalingam", see _simplifyPolyline
+
+        Returns:
+            index: The size of the image, the range encoded palette and the tolerance, minimum area and tiles of every level
+        """
+        assert levels > 0, f"Unknown number of levels {levels}!"
+        assert simplify_method in (
+            "douglas-peucker",
+            "visvalingam",
+        ), f"Unknown simplify_method {simplify_method}!"
+
+        h, w = self.getImage().shape[:2]
+        min_area = self.getImageArea() * self.pruningThreshold
+        labelMap, colorPalette = self.getLabelMap(copy=False)
+        labelMap = self._mergeSmallRegions(labelMap, min_area)
+        regionContours, regionMap, regionStats = self._traceRegions(
+            labelMap, min_area, holes=True
+        )
+        # Colors whose regions were all merged away have no shapes
+        regionContours += [[] for _ in range(len(colorPalette) - len(regionContours))]
+
+        palette = []
+        shapes = []
+        for idx, color in enumerate(colorPalette):
+            ids = range(len(shapes), len(shapes) + len(regionContours[idx]))
+            entry = {
+                "color": str(tuple(color.tolist())),
+                "shapes": [str(shapeId) for shapeId in ids],
+            }
+            if idx == self.borderIndex:
+                entry["border"] = True
+            palette.append(entry)
+            shapes += [
+                (idx, region, [ring.reshape(-1, 2) for ring in rings])
+                for region, rings in regionContours[idx]
+            ]
+
+        stats = regionStats[[region for _, region, _ in shapes]].reshape(-1, 5)
+        areas = stats[:, cv2.CC_STAT_AREA]
+        # The area each hole cuts out of its shape
+        holeAreas = [
+            [cv2.contourArea(ring.astype(np.int32)) for ring in rings[1:]]
+            for _, _, rings in shapes
+        ]
+        # The outlines are grown by a pixel around the region and the strokes by half a pixel around the outlines
+        lefts = stats[:, cv2.CC_STAT_LEFT] - 2
+        tops = stats[:, cv2.CC_STAT_TOP] - 2
+        rights = stats[:, cv2.CC_STAT_LEFT] + stats[:, cv2.CC_STAT_WIDTH] + 2
+        bottoms = stats[:, cv2.CC_STAT_TOP] + stats[:, cv2.CC_STAT_HEIGHT] + 2
+        centers = np.stack([lefts + rights, tops + bottoms], axis=1) / 2
+
+        index = {
+            "width": w,
+            "height": h,
+            "palette": encode_palette(palette),
+            "levels": [],
+        }
+        for level in range(levels):
+            scale = 2 ** (levels - 1 - level)
+            if scale == 1:
+                tolerance = simplify_tolerance
             else:
-                return (0, 0)
+                tolerance = (
+                    1.0 if simplify_tolerance is None else simplify_tolerance
+                ) * scale
+            # Shapes and holes smaller than a pixel at the scale of the level are left out, a hole is never smaller than
+            # the shapes nested in it so the shape paints over the left out ones
+            minArea = scale**2
+            kept = np.flatnonzero(areas >= minArea)
+            shapeRings = [
+                [shapes[shapeId][2][0]]
+                + [
+                    ring
+                    for ring, area in zip(shapes[shapeId][2][1:], holeAreas[shapeId])
+                    if area >= minArea
+                ]
+                for shapeId in kept
+            ]
+            if tolerance is not None:
+                simplified = iter(
+                    self._simplifyOutlines(
+                        [ring for rings in shapeRings for ring in rings],
+                        tolerance,
+                        simplify_method,
+                        closed=True,
+                    )
+                )
+                shapeRings = [[next(simplified) for _ in rings] for rings in shapeRings]
+
+            numTiles = 2**level
+            columns = np.minimum(centers[kept, 0] * numTiles // w, numTiles - 1)
+            rows = np.minimum(centers[kept, 1] * numTiles // h, numTiles - 1)
+            tileIds = (rows * numTiles + columns).astype(np.int64)
+
+            tiles = []
+            for tileId in np.unique(tileIds).tolist():
+                members = np.flatnonzero(tileIds == tileId)
+                shapeIds = kept[members]
+                left, top = int(lefts[shapeIds].min()), int(tops[shapeIds].min())
+                bounds = [
+                    left,
+                    top,
+                    int(rights[shapeIds].max()) - left,
+                    int(bottoms[shapeIds].max()) - top,
+                ]
+                row, column = divmod(tileId, numTiles)
+                fileName = f"{level}/{column}_{row}.svg"
+
+                with openTile(fileName) as outfile:
+                    writer = SvgWriter(outfile, *bounds[2:], origin=bounds[:2])
+                    for member, shapeId in zip(members.tolist(), shapeIds.tolist()):
+                        idx, region, _ = shapes[shapeId]
+                        contour, *holeContours = shapeRings[member]
+                        writer.begin_group(
+                            fill="white", stroke="black", id=str(shapeId)
+                        )
+                        self._writeShape(writer, contour, holeContours)
+                        if scale == 1:
+                            position = self.get_text_position(
+                                regionMap, region, regionStats[region]
+                            )
+                            self.add_text_label(writer, position, str(idx))
+                        writer.end_group()
+                    writer.close()
+
+                tiles.append(
+                    {"file": fileName, "bounds": bounds, "shapes": len(members)}
+                )
+
+            index["levels"].append(
+                {
+                    "level": level,
+                    "tolerance": tolerance,
+                    "minArea": minArea,
+                    "columns": numTiles,
+                    "rows": numTiles,
+                    "tiles": tiles,
+                }
+            )
+            print(f"level {level}: {len(kept)} shapes in {len(tiles)} tiles")
+
+        return index
+
+    def _writeShape(
+        self,
+        writer: SvgWriter,
+        contour: np.ndarray,
+        holeContours: tuple = (),
+        curves: bool = False,
+        compact: bool = False,
+        tolerance: float = 1.0,
+        **attributes,
+    ):
+        """
+        Writes the svg element of a traced shape, a polygon unless it has holes, is drawn with curves or is compact
+
+        Arguments:
+            writer: The SvgWriter of the document
+            contour: The OpenCV (N, 1, 2) outer contour of the shape
+            holeContours=(): The OpenCV contours of the holes of the shape
+            curves=False: Whether to fit cubic Bezier curves to the points, see _getCurveSegments
+            compact=False: Writes a path with relative path data, see output_to_svg
+            tolerance=1.0: How far in pixels the curves may stray from the points
+            attributes: Any other attributes of the element
+        """
+
+        if not curves and not holeContours and not compact:
+            writer.polygon(contour, **attributes)
+            return
+
+        rings = [ring.reshape(-1, 2) for ring in [contour, *holeContours]]
+        if curves:
+            rings = [
+                self._getCurveSegments(ring, closed=True, tolerance=tolerance)
+                for ring in rings
+            ]
+        pathData = self._getPathData(rings, relative=compact)
+        if holeContours:
+            # The holes are cut out whichever way they run
+            writer.path(pathData, fill_rule="evenodd", **attributes)
+        else:
+            writer.path(pathData, **attributes)
 
-        # Convert contour to a shapely polygon for area computation
-        polygon = Polygon([pt[0] for pt in contour])
-        min_x, min_y, max_x, max_y = polygon.bounds
-        best_point = (0, 0)
-        max_distance = -1
+    def _getUncoveredFraction(self, shapes: list, shape: tuple) -> float:
+        """
+        Fills the rings of every shape into a mask to find how much of the image no shape paints. The rings of a shape are
+        filled even-odd like the paths with holes, and strokes are not counted.
+
+        Arguments:
+            shapes: A list with a list of rings for every shape, each an OpenCV (N, 1, 2) contour or an (N, 2) array
+            shape: The (H, W) size of the image
+
+        Returns:
+            fraction: The fraction of pixels outside of every shape
+        """
+
+        painted = np.zeros(shape, dtype=np.uint8)
+        for rings in shapes:
+            cv2.fillPoly(
+                painted,
+                [np.asarray(ring, dtype=np.int32).reshape(-1, 1, 2) for ring in rings],
+                1,
+            )
 
-        for _ in range(num_samples):
-            x, y = random.uniform(min_x, max_x), random.uniform(min_y, max_y)
-            point = Point(x, y)
+        return 1 - np.count_nonzero(painted) / painted.size
 
-            # Check if the sampled point is within the polygon and its distance to edges
-            if polygon.contains(point):
-                distance = polygon.exterior.distance(point)
-                if distance > max_distance:
-                    max_distance = distance
-                    best_point = (x, y)
+    def get_text_position(
+        self, regionMap: np.ndarray, region: int, stats: np.ndarray
+    ) -> "tuple[int, int, float]":
+        """
+        Finds the pole of inaccessibility of a region, the pixel furthest from any other region or the image edge, with a
+        distance transform over the bounding box of the region
 
-        return best_point
+        Arguments:
+            regionMap: A (H, W) array of region ids from _getRegionMap
+            region: The id of the region
+            stats: The connected component stats of the region
 
-    def add_text_label(self, dwg, contour, label):
-        best_point = self.sample_text_position(contour)
+        Returns:
+            (x, y, radius)
+            x, y: The pixel furthest inside the region, the first one when there are several
+            radius: The distance from that pixel to the nearest pixel outside the region, about the radius of the
+                largest circle inside the region
+        """
+
+        x, y, w, h = stats[:4]
+        # A one pixel frame around the bounding box makes the image edge a border of the region too
+        mask = np.zeros((h + 2, w + 2), dtype=np.uint8)
+        mask[1:-1, 1:-1] = regionMap[y : y + h, x : x + w] == region
+        # The 5x5 mask gives the same distances on every call, the precise one can differ in the last bits
+        distances = cv2.distanceTransform(mask, cv2.DIST_L2, cv2.DIST_MASK_5)
+
+        row, col = np.unravel_index(np.argmax(distances), distances.shape)
+        return int(x + col - 1), int(y + row - 1), float(distances[row, col])
+
+    def add_text_label(self, writer, position, label, offset=0, compact=False):
+        x, y, radius = position
+
+        if compact:
+            # Whole pixel sizes and baselines, the anchor and colors come from the style of the label group
+            text_size = int(np.clip(round(radius), 4, 12))
+            writer.text(
+                label,
+                x + offset,
+                int(round(y + offset + 0.35 * text_size)),
+                font_size=text_size,
+            )
+            return
 
-        # Estimate a suitable text size
-        text_size = np.clip(np.sqrt(cv2.contourArea(contour)) / 8, 4, 12)
+        # The label fits inside the largest circle in the shape
+        text_size = round(float(np.clip(radius, 4, 12)), 1)
 
-        text = dwg.text(
+        # Pixels are centered on their coordinates in traced shapes and offset by half a pixel in topology shapes,
+        # the baseline is moved down to center the digits vertically
+        writer.text(
             label,
-            insert=best_point,
-            font_size=str(text_size),
+            x + offset,
+            round(y + offset + 0.35 * text_size, 2),
+            font_size=text_size,
             text_anchor="middle",
         )
-        return text
-        # dwg.add(text)
@@ -0,0 +1,179 @@
+from xml.sax.saxutils import escape
+
+import numpy as np
+
+SVG_NAMESPACES = {
+    "xmlns": "http://www.w3.org/2000/svg",
+    "xmlns:ev": "http://www.w3.org/2001/xml-events",
+    "xmlns:xlink": "http://www.w3.org/1999/xlink",
+}
+
+
+def format_attributes(attributes: dict) -> str:
+    """
+    Formats keyword attributes as svg attributes sorted by name like svgwrite, underscores in names become dashes and
+    a trailing underscore is dropped so reserved words like class can be passed as class_
+
+    Arguments:
+        attributes: A dictionary of attribute names and values, values are converted with str and escaped
+
+    Returns:
+        text: The attributes each preceded by a space
+    """
+
+    attributes = sorted(
+        (name.rstrip("_").replace("_", "-"), escape(str(value), {'"': "&quot;"}))
+        for name, value in attributes.items()
+    )
+    return "".join(f' {name}="{value}"' for name, value in attributes)
+
+
+def format_points(points: np.ndarray) -> str:
+    """
+    Formats all points of a polygon at once as "x,y x,y ..."
+
+    Arguments:
+        points: An OpenCV (N, 1, 2) contour or an (N, 2) array of points
+
+    Returns:
+        text: The points attribute value
+    """
+
+    return " ".join(f"{x},{y}" for x, y in np.asarray(points).reshape(-1, 2).tolist())
+
+
+class SvgWriter:
+    """
+    Writes an svg element by element to a binary stream instead of building the whole document in memory first.
+    Anything with a write(bytes) method works: a file opened with "wb", an io.BytesIO or a cloud storage blob writer.
+    Text is collected and encoded in chunks of about chunk_size bytes so the stream sees few large writes.
+    The markup matches what svgwrite writes for the same elements.
+    """
+
+    def __init__(
+        self,
+        stream,
+        width: int,
+        height: int,
+        xml_declaration: bool = True,
+        chunk_size: int = 1 << 16,
+        profile: str = "tiny",
+        origin: tuple = (0, 0),
+    ):
+        """
+        Writes the start of the document
+
+        Arguments:
+            stream: A binary stream to write to
+            width: The width of the view box
+            height: The height of the view box
+            xml_declaration=True: Starts the document with an xml declaration like svgwrite.Drawing.save
+            chunk_size=65536: About how many characters are collected before they are written to the stream
+            profile="tiny": The svg profile, "tiny" for svg 1.2 tiny like svgwrite or "full" for svg 1.1, which
+                allows style elements
+            origin=(0, 0): The top left corner of the view box, for documents that show part of a larger image
+        """
+
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.parts = []
+        self.size = 0
+        self.openGroups = 0
+        assert profile in ("tiny", "full"), f"Unknown profile {profile}!"
+
+        if xml_declaration:
+            self.write('<?xml version="1.0" encoding="utf-8" ?>\n')
+        attributes = {
+            "baseProfile": profile,
+            "height": "100%",
+            "version": "1.2" if profile == "tiny" else "1.1",
+            "viewBox": f"{origin[0]} {origin[1]} {width} {height}",
+            "width": "100%",
+            **SVG_NAMESPACES,
+        }
+        self.write(f"<svg{format_attributes(attributes)}><defs />")
+
+    def write(self, text: str):
+        """
+        Writes raw markup
+        """
+
+        self.parts.append(text)
+        self.size += len(text)
+        if self.size >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Encodes the collected markup and writes it to the stream
+        """
+
+        if self.parts:
+            self.stream.write("".join(self.parts).encode("utf-8"))
+            self.parts = []
+            self.size = 0
+
+    def element(self, tag: str, content: str = None, **attributes):
+        """
+        Writes a complete element
+
+        Arguments:
+            tag: The element name
+            content=None: Text inside the element, the element is written empty without it
+            attributes: The attributes of the element
+        """
+
+        if content is None:
+            self.write(f"<{tag}{format_attributes(attributes)} />")
+        else:
+            self.write(
+                f"<{tag}{format_attributes(attributes)}>{escape(content)}</{tag}>"
+            )
+
+    def begin_group(self, **attributes):
+        """
+        Opens a g element, every element written until end_group is inside it
+        """
+
+        self.write(f"<g{format_attributes(attributes)}>")
+        self.openGroups += 1
+
+    def end_group(self):
+        """
+        Closes the last group opened with begin_group
+        """
+
+        self.write("</g>")
+        self.openGroups -= 1
+
+    def polygon(self, points: np.ndarray, **attributes):
+        """
+        Writes a polygon from an OpenCV contour or an (N, 2) array of points
+        """
+
+        self.element("polygon", points=format_points(points), **attributes)
+
+    def path(self, d: str, **attributes):
+        """
+        Writes a path from its path data
+        """
+
+        self.element("path", d=d, **attributes)
+
+    def text(self, content: str, x, y, **attributes):
+        """
+        Writes a text element at x, y
+        """
+
+        self.element("text", content, x=x, y=y, **attributes)
+
+    def close(self):
+        """
+        Closes any open groups and the document and writes everything left to the stream.
+        The stream itself is left open.
+        """
+
+        while self.openGroups > 0:
+            self.end_group()
+        self.write("</svg>")
+        self.flush()